@@ -0,0 +1,172 @@
+# Cache module for Zillow Clustering Project
+# Keeps local copies of query results (and anything else expensive) in one folder,
+# named by a hash of what made them. If the SQL changes, so does the file name,
+# so old data never gets picked up by accident.
+import os
+import hashlib
+
+import pandas as pd
+
+# where cached files live, and how big the folder is allowed to get before the oldest files get dropped
+CACHE_DIR = 'zillow_cache'
+CACHE_MAX_BYTES = 2 * 1024**3
+
+# bump this when the shape of cached data changes (new columns, dtypes etc.) to invalidate everything
+SCHEMA_VERSION = 1
+
+# running hit / miss counts for this session
+CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+#########################
+
+def hash_key(*parts):
+    '''
+    Takes in any number of things (strings, numbers, lists, dicts...) and returns a sha256 hex string.
+    Same parts in, same key out.
+    '''
+    h = hashlib.sha256()
+
+    for part in parts:
+        h.update(repr(part).encode())
+        # separator so ('ab', 'c') and ('a', 'bc') don't collide
+        h.update(b'\x00')
+
+    return h.hexdigest()
+
+#########################
+
+def hash_frame(df):
+    '''
+    Takes in a dataframe (or series) and returns a sha256 hex string of its values, index and column names.
+    Uses pandas' vectorized row hashing, so it is one pass over the data.
+    '''
+    h = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+
+    # column names and dtypes aren't part of the row hashes
+    if isinstance(df, pd.DataFrame):
+        h.update(repr(list(df.columns)).encode())
+        h.update(repr(list(df.dtypes.astype(str))).encode())
+
+    return h.hexdigest()
+
+#########################
+
+def query_key(database, sql_query, schema_version=SCHEMA_VERSION):
+    '''
+    Cache key for a query result: hash of the database name, the SQL text (whitespace normalized) and the schema version
+    '''
+    return hash_key(database, ' '.join(sql_query.split()), schema_version)
+
+#########################
+
+def cache_path(key, ext, cache_dir=CACHE_DIR):
+    '''
+    Returns the file path for a cache key with the given extension (i.e. 'parquet', 'csv', 'pkl')
+    Creates the cache folder if it doesn't exist
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return os.path.join(cache_dir, f'{key}.{ext}')
+
+#########################
+
+def lookup(path):
+    '''
+    Checks if a cache file exists and counts a hit or a miss.
+    On a hit the file's modified time gets bumped, which is what eviction uses to decide what was least recently used.
+    Returns True on a hit
+    '''
+    if os.path.isfile(path):
+
+        CACHE_STATS['hits'] += 1
+        os.utime(path)
+
+        return True
+
+    CACHE_STATS['misses'] += 1
+
+    return False
+
+#########################
+
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, keep=()):
+    '''
+    Deletes least recently used entries until the cache folder is under max_bytes.
+    Files that share a key (i.e. abc.parquet and abc.sync.json) are one entry and get dropped together.
+    keep = paths that should never be evicted (i.e. the file that was just written)
+    Returns number of entries evicted
+    '''
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    # group files by key -> [size, last used, paths]
+    entries = {}
+
+    for name in os.listdir(cache_dir):
+
+        path = os.path.join(cache_dir, name)
+        if not os.path.isfile(path):
+            continue
+
+        stat = os.stat(path)
+        entry = entries.setdefault(name.split('.')[0], [0, 0, []])
+        entry[0] += stat.st_size
+        entry[1] = max(entry[1], stat.st_mtime)
+        entry[2].append(path)
+
+    total = sum(entry[0] for entry in entries.values())
+    keep = {os.path.abspath(path) for path in keep}
+    evicted = 0
+
+    # oldest first
+    for size, last_used, paths in sorted(entries.values(), key=lambda entry: entry[1]):
+
+        if total <= max_bytes:
+            break
+
+        if any(os.path.abspath(path) in keep for path in paths):
+            continue
+
+        for path in paths:
+            os.remove(path)
+
+        total -= size
+        evicted += 1
+        CACHE_STATS['evictions'] += 1
+        CACHE_STATS['evicted_bytes'] += size
+
+    return evicted
+
+#########################
+
+def cache_stats(cache_dir=CACHE_DIR):
+    '''
+    Returns a dictionary with this session's hits, misses, evictions and hit rate,
+    plus how many entries and bytes are in the cache folder right now
+    '''
+    stats = dict(CACHE_STATS)
+
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+
+    files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)] if os.path.isdir(cache_dir) else []
+
+    stats['entries'] = len({os.path.basename(path).split('.')[0] for path in files})
+    stats['bytes'] = sum(os.path.getsize(path) for path in files if os.path.isfile(path))
+
+    return stats
+
+#########################
+
+def clear_cache(cache_dir=CACHE_DIR):
+    '''
+    Deletes everything in the cache folder and resets the stats
+    '''
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    for stat in CACHE_STATS:
+        CACHE_STATS[stat] = 0
@@ -0,0 +1,348 @@
+# Cluster module for Zillow Clustering Project
+# The KMeans fitting and predicting that make_this_cluster (wrangle) and makin_clusters (explore) use.
+# Pick a backend:
+#   'kmeans'      - regular KMeans, same as always
+#   'minibatch'   - MiniBatchKMeans, fits on small random batches, much faster on big data
+#   'incremental' - MiniBatchKMeans.partial_fit one batch (or chunk) at a time, for data that doesn't fit comfortably
+import os
+import time
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score, calinski_harabasz_score
+from threadpoolctl import threadpool_limits
+
+import cache
+
+BACKENDS = ('kmeans', 'minibatch', 'incremental')
+
+#########################
+
+def thread_limit(n_threads):
+    '''
+    Context manager that limits numpy / sklearn threads to n_threads, does nothing if n_threads is None
+    '''
+    return nullcontext() if n_threads is None else threadpool_limits(limits=n_threads)
+
+#########################
+
+def make_kmeans(k, backend = 'kmeans', batch_size = 4096, random_state = 713):
+    '''
+    Returns an unfitted model for the backend with k clusters
+    '''
+    if backend == 'kmeans':
+        return KMeans(n_clusters=k, random_state=random_state)
+
+    if backend in ('minibatch', 'incremental'):
+        return MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=random_state, n_init=3)
+
+    raise ValueError(f'backend must be one of {BACKENDS}, got {backend}')
+
+#########################
+
+def _batches(X, batch_size):
+    '''
+    Yields 2d arrays (or dataframes) of at most batch_size rows. X can be a dataframe, an array,
+    or an iterable of chunks (dataframes or arrays) that may be any size
+    '''
+    if isinstance(X, pd.DataFrame):
+        # dataframe batches keep their column names, so predict later doesn't complain
+        for start in range(0, len(X), batch_size):
+            yield X.iloc[start:start + batch_size]
+        return
+
+    if isinstance(X, np.ndarray):
+        for start in range(0, len(X), batch_size):
+            yield X[start:start + batch_size]
+        return
+
+    for chunk in X:
+        yield from _batches(chunk if isinstance(chunk, pd.DataFrame) else np.asarray(chunk), batch_size)
+
+#########################
+
+def fit_clusters(X, k, backend = 'kmeans', batch_size = 4096, n_threads = None, n_epochs = 1, random_state = 713):
+    '''
+    Fits a clustering model with k clusters.
+    X = dataframe or array to cluster. For the 'incremental' backend it can also be a function that returns
+        a new iterable of chunks each time it is called (only one chunk is in memory at a time)
+    backend = 'kmeans' (default), 'minibatch' or 'incremental' (see top of module)
+    batch_size = rows per batch for the minibatch backends
+    n_threads = optional limit on the threads numpy / sklearn use while fitting (None means no limit)
+    n_epochs = passes over the data for 'incremental'
+    For 'kmeans' and 'minibatch' the model's labels_ are the train clusters, no need to predict train again.
+    Returns the fitted model
+    '''
+    model = make_kmeans(k, backend, batch_size, random_state)
+
+    with thread_limit(n_threads):
+
+        if backend != 'incremental':
+            return model.fit(X)
+
+        for _ in range(n_epochs):
+
+            # the first partial_fit needs at least k rows, batches smaller than that
+            # get held back and put in front of the next one
+            held = None
+
+            for batch in _batches(X() if callable(X) else X, batch_size):
+
+                if held is not None:
+                    batch = pd.concat([held, batch]) if isinstance(batch, pd.DataFrame) else np.vstack([held, batch])
+                    held = None
+
+                if len(batch) < k and not hasattr(model, 'cluster_centers_'):
+                    held = batch
+                    continue
+
+                model.partial_fit(batch)
+
+            # rows still held at the end of the data (fewer than k rows in total)
+            if held is not None:
+                raise ValueError(f'need at least k = {k} rows to fit, only got {len(held)}')
+
+    return model
+
+#########################
+
+def predict_clusters(model, frames, col_list = None, n_threads = None):
+    '''
+    Predicts clusters for several dataframes (i.e. [validate, test]) with one predict call.
+    col_list = columns to use (default all the columns)
+    n_threads = optional thread limit
+    Returns a list of label arrays, one per frame, in the same order
+    '''
+    blocks = [frame if col_list is None else frame[col_list] for frame in frames]
+
+    # keep dataframes as dataframes so the column names still match what the model was fit on
+    X = pd.concat(blocks, ignore_index=True) if isinstance(blocks[0], pd.DataFrame) else np.vstack(blocks)
+
+    with thread_limit(n_threads):
+        labels = model.predict(X)
+
+    # cut back into one array per frame
+    return np.split(labels, np.cumsum([len(block) for block in blocks])[:-1])
+
+#########################
+
+def train_labels(model, X, backend, n_threads = None):
+    '''
+    Cluster labels for the data the model was fit on.
+    Reuses labels_ from the fit, except for 'incremental' (labels_ there only covers the last batch)
+    '''
+    if backend == 'incremental':
+        return predict_clusters(model, [X], n_threads=n_threads)[0]
+
+    return model.labels_
+
+#########################
+
+def benchmark_clusters(X, k, scales = (1, 10, 100), backends = BACKENDS, n_threads = None, random_state = 713):
+    '''
+    Times the old way (KMeans fit, then predict on train again) against each backend
+    (fit, reuse labels_ for train) on X repeated scales times with a little noise added.
+    X = scaled dataframe or array (i.e. train[['latitude', 'longitude', 'ppsqft']])
+    Returns a dataframe with rows, method, seconds and inertia (on the full data) for each scale
+    '''
+    rng = np.random.default_rng(random_state)
+    X = np.asarray(X, dtype=np.float64)
+    noise = X.std(axis=0) * .01
+
+    results = []
+
+    for scale in scales:
+
+        # bigger copy of the data, jittered so the rows aren't exact duplicates
+        X_big = np.repeat(X, scale, axis=0)
+        X_big += rng.normal(0, 1, X_big.shape) * noise
+
+        # the original path
+        start = time.perf_counter()
+        model = KMeans(n_clusters=k, random_state=random_state).fit(X_big)
+        model.predict(X_big)
+        results.append({'rows': len(X_big), 'method': 'current (fit + predict)',
+                        'seconds': time.perf_counter() - start, 'inertia': model.inertia_})
+
+        for backend in backends:
+
+            start = time.perf_counter()
+            model = fit_clusters(X_big, k, backend = backend, n_threads = n_threads, random_state = random_state)
+            labels = train_labels(model, X_big, backend, n_threads)
+            seconds = time.perf_counter() - start
+
+            # inertia of the labels on all the data, so the backends can be compared fairly
+            inertia = ((X_big - model.cluster_centers_[labels]) ** 2).sum()
+
+            results.append({'rows': len(X_big), 'method': backend, 'seconds': seconds, 'inertia': inertia})
+
+    return pd.DataFrame(results)
+
+#########################
+
+def _sweep_one(X, k, backend, random_state, sample_size):
+    '''
+    Fits one k for k_sweep (runs in a worker process).
+    Silhouette and Calinski-Harabasz are scored on a random sample of sample_size rows, silhouette is O(n^2) on the full data
+    Returns a dictionary with the scores and the fitted model
+    '''
+    # one thread per worker, the pool is already using the cores
+    with thread_limit(1):
+
+        start = time.perf_counter()
+        model = fit_clusters(X, k, backend = backend, random_state = random_state)
+        seconds = time.perf_counter() - start
+
+        labels = train_labels(model, X, backend)
+
+        # same sample for every k so the scores are comparable
+        rng = np.random.default_rng(random_state)
+        sample = rng.choice(len(X), sample_size, replace=False) if sample_size and len(X) > sample_size else slice(None)
+
+        # both scores need at least 2 clusters in the sample
+        if len(np.unique(labels[sample])) > 1:
+            silhouette = silhouette_score(X[sample], labels[sample])
+            calinski = calinski_harabasz_score(X[sample], labels[sample])
+        else:
+            silhouette = calinski = np.nan
+
+    # inertia of the labels on all the data, the incremental backend's inertia_ only covers its last batch
+    inertia = ((X - model.cluster_centers_[labels]) ** 2).sum()
+
+    return {'k': k, 'inertia': inertia, 'silhouette': silhouette, 'calinski_harabasz': calinski,
+            'fit_seconds': seconds, 'model': model}
+
+#########################
+
+def k_sweep(X, k_range = range(2, 10), backend = 'kmeans', random_state = 713, sample_size = 10_000,
+            max_workers = None, use_cache = True, cache_dir = cache.CACHE_DIR):
+    '''
+    Fits a clustering model for every k in k_range, in a process pool, and scores each one.
+    X = scaled dataframe or array
+    sample_size = rows used for the silhouette and Calinski-Harabasz scores (None for all of them)
+    max_workers = processes to use (default one per core, capped at the number of k's to fit)
+    use_cache = results are cached by (data hash, k, seed, backend, sample size), so re-running
+                or re-plotting with the same data only fits the new k's
+    Returns a dataframe indexed by k with inertia (on all of X, for every backend), silhouette, calinski_harabasz, fit_seconds and the fitted model
+    '''
+    X = X if isinstance(X, pd.DataFrame) else pd.DataFrame(np.asarray(X))
+    data_key = cache.hash_frame(X)
+    values = X.to_numpy(dtype=np.float64)
+
+    results = {}
+    paths = {}
+
+    for k in k_range:
+        # 'k_sweep', 2: older entries had last batch inertia for 'incremental', don't pick those up
+        paths[k] = cache.cache_path(cache.hash_key('k_sweep', 2, data_key, k, random_state, backend, sample_size), 'pkl', cache_dir)
+        if use_cache and cache.lookup(paths[k]):
+            results[k] = pd.read_pickle(paths[k])
+
+    todo = [k for k in k_range if k not in results]
+
+    if todo:
+
+        workers = min(max_workers or os.cpu_count() or 1, len(todo))
+
+        if workers == 1:
+            fitted = [_sweep_one(values, k, backend, random_state, sample_size) for k in todo]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                fitted = list(pool.map(_sweep_one, *zip(*[(values, k, backend, random_state, sample_size) for k in todo])))
+
+        for result in fitted:
+            results[result['k']] = result
+            if use_cache:
+                pd.to_pickle(result, paths[result['k']])
+
+        if use_cache:
+            cache.evict(cache_dir, keep=list(paths.values()))
+
+    return pd.DataFrame([results[k] for k in k_range]).set_index('k')
+
+#########################
+
+def npz_path(path):
+    '''
+    path with .npz on the end, the name np.savez actually writes to (it adds .npz when it's missing)
+    '''
+    return path if str(path).endswith('.npz') else f'{path}.npz'
+
+#########################
+
+class ClusterAssigner:
+    '''
+    Puts new parcels into the clusters a fitted model already found, without re-running wrangle_pt2.
+    Holds only what it needs: the MinMax parameters for the cluster columns and the centroids (in scaled units).
+    Make one with ClusterAssigner.from_fitted(scaler, kmeans, col_list, scaled_cols), save it with .save(path)
+    and get it back with ClusterAssigner.load(path).
+    assign(latitude=..., longitude=..., ppsqft=...) takes single values or arrays, assign_frame(df) takes raw rows.
+    '''
+    def __init__(self, col_list, scale, offset, centroids):
+        # scaled = raw * scale + offset (same as MinMaxScaler's scale_ and min_)
+        self.col_list = list(col_list)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        
+        # nearest centroid is argmin over ||raw * scale + offset - c||^2. Folding the scaling into the centroids
+        # leaves argmin of (bias - 2 * raw @ weights), so assigning is one small matrix multiply
+        shifted = self.centroids - self.offset
+        self.weights = np.ascontiguousarray((2 * shifted * self.scale).T)
+        self.bias = (shifted ** 2).sum(axis=1)
+    
+    @classmethod
+    def from_fitted(cls, scaler, kmeans, col_list, scaled_cols = None):
+        '''
+        scaler = fitted MinMaxScaler (can cover more columns than the cluster used)
+        kmeans = fitted model with cluster_centers_ in scaled units
+        col_list = columns the clusters were made on, in the order the model saw them
+        scaled_cols = columns the scaler was fit on, in order (default col_list)
+        '''
+        scaled_cols = list(col_list if scaled_cols is None else scaled_cols)
+        positions = [scaled_cols.index(col) for col in col_list]
+        
+        return cls(col_list, scaler.scale_[positions], scaler.min_[positions], kmeans.cluster_centers_)
+    
+    def save(self, path):
+        '''
+        Saves to a small .npz file (.npz gets added to path if it isn't there)
+        '''
+        np.savez(npz_path(path), col_list=np.array(self.col_list), scale=self.scale, offset=self.offset, centroids=self.centroids)
+    
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a ClusterAssigner saved with save, path with or without the .npz
+        '''
+        with np.load(npz_path(path)) as saved:
+            return cls(saved['col_list'].tolist(), saved['scale'], saved['offset'], saved['centroids'])
+    
+    def assign_array(self, X):
+        '''
+        X = raw (unscaled) values, shape (rows, columns in col_list order) or one row
+        Returns array of cluster numbers
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        
+        return np.argmin(self.bias - np.atleast_2d(X) @ self.weights, axis=1)
+    
+    def assign(self, **values):
+        '''
+        Cluster for raw values given by column name, i.e. assign(latitude=34.1, longitude=-118.3, ppsqft=250)
+        Single values return a single cluster number, arrays return an array
+        '''
+        X = np.column_stack([np.asarray(values[col], dtype=np.float64) for col in self.col_list])
+        labels = self.assign_array(X)
+        
+        return int(labels[0]) if np.ndim(values[self.col_list[0]]) == 0 else labels
+    
+    def assign_frame(self, df):
+        '''
+        Clusters for a dataframe of raw rows (needs the col_list columns), returns a series lined up with df
+        '''
+        return pd.Series(self.assign_array(df[self.col_list].to_numpy(dtype=np.float64)), index=df.index)
@@ -1,12 +1,113 @@
+import time
+import weakref
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from sklearn.metrics import r2_score, mean_squared_error
 from sklearn.linear_model import LinearRegression
 from sklearn.feature_selection import SelectKBest, f_regression, RFE
+from sklearn.base import clone
+from joblib import Parallel, delayed
+
+import cache
+from explore import resolve_plot_mode, draw_points, finish_plot
+
+
+################################################################################################
+
+# feature rankings already worked out, by (hash of X, hash of y, fit_intercept) -> dataframe
+_feature_rankings = {}
+
+def _gram(X, y, center = True):
+    '''
+    Returns X^T X and X^T y (centered first if center), plus y^T y and the number of rows.
+    Everything feature_ranking needs, one pass over the data.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    
+    if center:
+        X = X - X.mean(axis=0)
+        y = y - y.mean()
+    
+    return X.T @ X, X.T @ y, y @ y, len(y)
 
+################################################################################################
+
+def _rfe_order(xtx, xty):
+    '''
+    Recursive feature elimination for a linear regression, worked out from the gram matrix only.
+    Each step drops the feature with the smallest absolute coefficient (same as sklearn's RFE with step = 1).
+    The coefficients after a drop come from a rank one update of the inverse, no refitting.
+    Returns feature positions in the order they were eliminated (the last one is the best)
+    '''
+    remaining = list(range(len(xty)))
+    eliminated = []
+    
+    # the update needs a real inverse, lstsq on the sub matrix every step if it's (nearly) singular
+    well_conditioned = np.linalg.cond(xtx) < 1e10
+    if well_conditioned:
+        inv = np.linalg.inv(xtx)
+        coef = inv @ xty
+    
+    while len(remaining) > 1:
+        
+        if not well_conditioned:
+            sub = np.ix_(remaining, remaining)
+            coef = np.linalg.lstsq(xtx[sub], xty[remaining], rcond=None)[0]
+        
+        j = int(np.argmin(np.abs(coef)))
+        eliminated.append(remaining.pop(j))
+        
+        if well_conditioned:
+            # drop row / column j from the inverse and fix up the coefficients
+            keep = np.arange(len(coef)) != j
+            col = inv[keep, j]
+            coef = coef[keep] - col * coef[j] / inv[j, j]
+            inv = inv[np.ix_(keep, keep)] - np.outer(col, col) / inv[j, j]
+    
+    return eliminated + remaining
+
+################################################################################################
+
+def feature_ranking(X, y, fit_intercept = True):
+    '''
+    Ranks every feature in X once, for both rfe and select_kbest, from X^T X and X^T y.
+    Returns a dataframe indexed by feature name with:
+        rfe_rank  = 1 is the last feature RFE (LinearRegression) would keep, rfe(X, y, n) is the features with rfe_rank <= n
+        f_score   = f_regression score, kbest_rank = 1 for the highest score, select_kbest(X, y, k) is kbest_rank <= k
+    Results are cached by a hash of X and y, so trying different n's and k's costs nothing after the first one.
+    '''
+    key = (cache.hash_frame(X), cache.hash_frame(y), fit_intercept)
+    
+    if key in _feature_rankings:
+        return _feature_rankings[key]
+    
+    xtx, xty, yty, n_rows = _gram(X, y, fit_intercept)
+    
+    # rfe
+    rfe_rank = np.empty(len(xty), dtype=np.int64)
+    rfe_rank[_rfe_order(xtx, xty)] = np.arange(len(xty), 0, -1)
+    
+    # f_regression is the squared correlation of each feature with y, turned into an F score (always centered)
+    if not fit_intercept:
+        xtx, xty, yty, n_rows = _gram(X, y)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = xty / np.sqrt(np.diag(xtx) * yty)
+        f_score = corr ** 2 / (1 - corr ** 2) * (n_rows - 2)
+    
+    # same tie breaking as SelectKBest (stable sort, later columns win ties)
+    kbest_rank = np.empty(len(xty), dtype=np.int64)
+    kbest_rank[np.argsort(np.nan_to_num(f_score, nan=-np.inf), kind='mergesort')[::-1]] = np.arange(1, len(xty) + 1)
+    
+    ranking = pd.DataFrame({'rfe_rank': rfe_rank, 'f_score': f_score, 'kbest_rank': kbest_rank}, index=X.columns)
+    
+    _feature_rankings[key] = ranking
+    
+    return ranking
 
 ################################################################################################
 
@@ -15,7 +116,12 @@ def select_kbest(X, y, k, score_func=f_regression):
     takes in the predictors (X), the target (y), and the number of features to select (k) 
     and returns the names (in a list) of the top k selected features based on the SelectKBest class
     Optional arg: score_func. Default is f_regression. other options ex: f_classif 
+    With f_regression the scores come from feature_ranking (cached), anything else goes through SelectKBest
     '''
+    if score_func is f_regression:
+        ranking = feature_ranking(X, y)
+        return list(X.columns[ranking.kbest_rank.to_numpy() <= k])
+    
     # create selector
     f_selector = SelectKBest(score_func=score_func, k=k)
     
@@ -33,7 +139,14 @@ def rfe(X, y, n, estimator=LinearRegression()):
     takes in the predictors (X), the target (y), and the number of features to select (n) 
     and returns the names (in a list) of the top k selected features based on the Recursive Feature Elimination class
     Optional arg: estimator. Default is LinearRegression()
+    A plain LinearRegression uses feature_ranking (gram matrix, cached), any other estimator goes through sklearn's RFE
     '''
+    # only a plain LinearRegression can be worked out from the gram matrix
+    params = estimator.get_params()
+    if type(estimator) is LinearRegression and not params['positive']:
+        ranking = feature_ranking(X, y, fit_intercept = params['fit_intercept'])
+        return list(X.columns[ranking.rfe_rank.to_numpy() <= n])
+    
     # use the estimator model to create estimator
     est = estimator
     
@@ -74,13 +187,78 @@ def compare_rmse(df_pred_actuals):
     '''
     for df_name, prediction, actual in df_pred_actuals:
         
-        rmse = mean_squared_error(prediction, actual, squared = False)
+        rmse = regression_metrics(pd.DataFrame({'prediction': np.asarray(prediction)}), actual).rmse.iloc[0]
                
         print(f'{df_name} RMSE for {prediction.name}: {rmse} ')
 
 
 ################################################################################################
 
+def regression_metrics(df, actuals, pred_cols = None, n_boot = 0, ci = .95, random_state = 713, max_cells = 20_000_000):
+    '''
+    RMSE, MAE and R^2 for a bunch of prediction columns at once (all the models plus the baseline).
+    df = dataframe with the prediction columns, actuals = the target (series, array, or a column name in df)
+    pred_cols = prediction columns (default every column but actuals)
+    n_boot = number of bootstrap resamples for confidence intervals (0 = none)
+    ci = confidence level for the intervals, i.e. .95 gives the 2.5% and 97.5% percentiles
+    max_cells = cap on the size of each batch of bootstrap weights (resamples x rows), keeps memory down
+    Every column is scored in one pass on the (rows x models) error block. Bootstrap resamples are rows of 
+    multinomial counts, so a whole batch of resamples is one matrix multiply instead of a loop per resample.
+    Returns a dataframe (one row per prediction column) with rmse, mae, r2 
+    and rmse_low, rmse_high, mae_low, ... when n_boot > 0
+    '''
+    if isinstance(actuals, str):
+        pred_cols = pred_cols or [col for col in df.columns if col != actuals]
+        actuals = df[actuals]
+    
+    pred_cols = pred_cols or list(df.columns)
+    
+    y = np.asarray(actuals, dtype=np.float64)
+    errors = df[pred_cols].to_numpy(dtype=np.float64) - y[:, None]
+    n_rows = len(y)
+    
+    sq_errors = errors ** 2
+    abs_errors = np.abs(errors)
+    ss_total = ((y - y.mean()) ** 2).sum()
+    
+    metrics = pd.DataFrame({'rmse': np.sqrt(sq_errors.mean(axis=0)),
+                            'mae': abs_errors.mean(axis=0),
+                            'r2': 1 - sq_errors.sum(axis=0) / ss_total}, index=pred_cols)
+    
+    if not n_boot:
+        return metrics
+    
+    rng = np.random.default_rng(random_state)
+    batch = max(1, min(n_boot, max_cells // n_rows))
+    boot = {'rmse': [], 'mae': [], 'r2': []}
+    
+    for start in range(0, n_boot, batch):
+        
+        # how many times each row shows up in each resample (multinomial counts), (resamples x rows)
+        # one bincount over the whole batch of resample indices, offset so each resample gets its own row
+        size = min(batch, n_boot - start)
+        picks = rng.integers(0, n_rows, (size, n_rows)) + np.arange(size)[:, None] * n_rows
+        weights = np.bincount(picks.ravel(), minlength=size * n_rows).reshape(size, n_rows).astype(np.float64)
+        
+        sse = weights @ sq_errors
+        # total sum of squares of y in each resample: sum(w * y^2) - (sum(w * y))^2 / n
+        sst = weights @ (y ** 2) - (weights @ y) ** 2 / n_rows
+        
+        boot['rmse'].append(np.sqrt(sse / n_rows))
+        boot['mae'].append(weights @ abs_errors / n_rows)
+        boot['r2'].append(1 - sse / sst[:, None])
+    
+    tail = (1 - ci) / 2 * 100
+    
+    for metric, values in boot.items():
+        low, high = np.percentile(np.vstack(values), [tail, 100 - tail], axis=0)
+        metrics[f'{metric}_low'] = low
+        metrics[f'{metric}_high'] = high
+    
+    return metrics
+
+################################################################################################
+
 # this function has some issues 
 def regression_modeler_for_validating(X_cols, y_col, train, validate, model= LinearRegression(), model_name = 'model'):
     '''
@@ -131,8 +309,59 @@ def regression_modeler_for_TEST(X_cols, y_col, train, validate, test, model= Lin
     compare_rmse([('train', train[model_name], train[y_col]), ('validate', validate[model_name], validate[y_col])]) 
 
 ################################################################################################
+
+def _fit_one(name, model, X_train, y_train, X_validate, y_validate):
+    '''
+    Fits and scores one model for model_tournament (runs in a worker process).
+    Returns a dictionary of results and the fitted model
+    '''
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    train_pred = model.predict(X_train)
+    validate_pred = model.predict(X_validate)
+    predict_seconds = time.perf_counter() - start
+    
+    results = {'model': name, 
+               'train_rmse': np.sqrt(np.mean((train_pred - y_train) ** 2)),
+               'validate_rmse': np.sqrt(np.mean((validate_pred - y_validate) ** 2)),
+               'fit_seconds': fit_seconds, 'predict_seconds': predict_seconds}
+    
+    return results, model
+
+################################################################################################
+
+def model_tournament(models, X_cols, y_col, train, validate, n_jobs = -1, return_models = False):
+    '''
+    Fits a bunch of models at once and compares them, without touching train or validate.
+    models = dictionary of {name: unfitted model}, i.e. {'ols': LinearRegression(), 'lasso': LassoLars(alpha=1)}
+    X_cols = list of feature columns, y_col = target column name
+    n_jobs = worker processes (-1 = one per core). The feature matrices are made once and shared read only
+             with the workers (joblib memory maps the big ones instead of copying them to every process)
+    return_models = if True also returns a dictionary of {name: fitted model}
+    Returns a dataframe (best validate RMSE first) with train_rmse, validate_rmse, fit_seconds and predict_seconds
+    '''
+    X_train = train[X_cols].to_numpy(dtype=np.float64)
+    y_train = train[y_col].to_numpy(dtype=np.float64)
+    X_validate = validate[X_cols].to_numpy(dtype=np.float64)
+    y_validate = validate[y_col].to_numpy(dtype=np.float64)
+    
+    # clone so the caller's models stay unfitted
+    fitted = Parallel(n_jobs=n_jobs)(delayed(_fit_one)(name, clone(model), X_train, y_train, X_validate, y_validate) 
+                                     for name, model in models.items())
+    
+    results = pd.DataFrame([result for result, model in fitted]).set_index('model').sort_values('validate_rmse')
+    
+    if return_models:
+        return results, {result['model']: model for result, model in fitted}
+    
+    return results
+
+################################################################################################
     
-def compare_to_basline(df, actuals, model_name, df_name, baseline = 'baseline'):
+def compare_to_basline(df, actuals, model_name, df_name, baseline = 'baseline', n_boot = 0):
     '''
     this function takes in a dataframe (i.e. train)
     the actuals (i.e. y_train)
@@ -142,15 +371,14 @@ def compare_to_basline(df, actuals, model_name, df_name, baseline = 'baseline'):
     default is 'baseline'
     function prints out the RMSE for the df predictions, baseline, and whether or not 
     it is better than the baseline
+    n_boot = optional number of bootstrap resamples, also prints 95% confidence intervals for both RMSEs
     '''
     # get name of dataframe entered --> Broken need to fix <----- 
     # name =[x for x in globals() if globals()[x] is df][0]
 
-    # calculate model RMSE
-    rmse = mean_squared_error(df[model_name], actuals, squared = False)
-    
-    # calculate baseline RMSE 
-    rmse_b = mean_squared_error(df[baseline], actuals, squared = False)
+    # calculate model and baseline RMSE in one go
+    metrics = regression_metrics(df, actuals, [model_name, baseline], n_boot = n_boot)
+    rmse, rmse_b = metrics.rmse
     
     # print it all out
     print(f'''------- {df_name} ---------\n
@@ -158,53 +386,280 @@ RMSE for {model_name}: {rmse}\n
 RMSE for baseline: {rmse_b}\n
 Better than baseline?: {rmse < rmse_b} by {rmse_b - rmse}
         ''')
+    
+    if n_boot:
+        for col in (model_name, baseline):
+            print(f'95% CI for {col} RMSE: ({metrics.rmse_low[col]}, {metrics.rmse_high[col]})')
+################################################################################################
+
+# partitions already worked out, by (id of the dataframe, column) -> (weak reference to the dataframe, Partition)
+_partitions = {}
+
+class Partition:
+    '''
+    A dataframe grouped by one column, done with one stable sort.
+    Every segment is a contiguous block of the sorted rows: rows order[starts[i]:ends[i]] are segment keys[i],
+    in their original order. Only the offsets are kept (not the data), so they never go stale when other columns change.
+    part[key] takes one segment's rows straight from df (no boolean mask over the whole frame), 
+    items() sorts the frame once and hands back each segment as a slice of that one copy.
+    Only a weak reference to df is kept, so a cached Partition never keeps a dataframe alive.
+    Make one with partition(df, col), that way it is only worked out once per dataframe and column.
+    '''
+    def __init__(self, df, segment_col):
+        self._df = weakref.ref(df)
+        self.index = df.index
+        self.segment_col = segment_col
+        # own copy, so changes to the column in place show up in matches
+        self.values = df[segment_col].to_numpy(copy=True)
+        
+        self.order = np.argsort(self.values, kind='stable')
+        sorted_values = self.values[self.order]
+        
+        # where the segment changes in sorted order
+        if len(self.order):
+            self.starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+        else:
+            self.starts = np.array([], dtype=np.int64)
+        self.ends = np.r_[self.starts[1:], len(self.order)].astype(np.int64)
+        self.keys = sorted_values[self.starts]
+        
+        # key -> segment number, plain python keys so 1 finds True and 1.0 finds 1
+        self._lookup = {key.item() if hasattr(key, 'item') else key: i for i, key in enumerate(self.keys)}
+    
+    @property
+    def df(self):
+        '''
+        The dataframe this partition was made from (an error if it has been deleted since)
+        '''
+        df = self._df()
+        
+        if df is None:
+            raise ReferenceError('the dataframe for this Partition has been deleted')
+        
+        return df
+    
+    def matches(self, df):
+        '''
+        True if this partition still lines up with df (same index and same segment values)
+        '''
+        return (df.index is self.index or df.index.equals(self.index)) and np.array_equal(
+            df[self.segment_col].to_numpy(), self.values)
+    
+    def sizes(self):
+        '''
+        Series of rows per segment
+        '''
+        return pd.Series(self.ends - self.starts, index=self.keys, name='rows')
+    
+    def slices(self):
+        '''
+        Yields (key, start, end) for each segment, positions are in sorted order (see take)
+        '''
+        return zip(self.keys, self.starts, self.ends)
+    
+    def take(self, values):
+        '''
+        Puts an array (one row per row of df) into sorted order, so each segment is values[start:end]
+        '''
+        return np.asarray(values)[self.order]
+    
+    def positions(self, key):
+        '''
+        Row positions (in df) of a segment, empty if the key isn't there
+        '''
+        i = self._lookup.get(key.item() if hasattr(key, 'item') else key)
+        
+        if i is None:
+            return self.order[:0]
+        
+        return self.order[self.starts[i]:self.ends[i]]
+    
+    def __getitem__(self, key):
+        '''
+        The rows of one segment as a dataframe (empty with the same columns if the key isn't there)
+        '''
+        return self.df.take(self.positions(key))
+    
+    def items(self):
+        '''
+        Yields (key, segment dataframe) for each segment, all slices of one sorted copy of df
+        '''
+        sorted_df = self.df.take(self.order)
+        
+        for key, start, end in self.slices():
+            yield key, sorted_df.iloc[start:end]
+
+################################################################################################
+
+def partition(df, segment_col, refresh = False):
+    '''
+    Returns the Partition of df by segment_col, reusing the one from last time 
+    if df and its segment column haven't changed (refresh = True to always redo it)
+    '''
+    key = (id(df), segment_col)
+    
+    if not refresh and key in _partitions:
+        ref, part = _partitions[key]
+        if ref() is df and part.matches(df):
+            return part
+    
+    part = Partition(df, segment_col)
+    
+    # drop the entry when the dataframe goes away, so ids that get reused don't get the wrong partition
+    _partitions[key] = (weakref.ref(df, lambda ref, key=key: _partitions.pop(key, None)), part)
+    
+    return part
+
 ################################################################################################
 
 # Create function to do seperate dataframes for old and new
 def old_new(df):
     '''
+    Takes in a dataframe with the built_before_1978 column, returns df_old, df_new.
+    Uses partition, so both come out of one sort and asking again for the same df is free.
     '''
+    part = partition(df, 'built_before_1978')
+    
     # old
-    df_old = df[df['built_before_1978'] == 1]
+    df_old = part[1]
     
     # new
-    df_new = df[df['built_before_1978'] == 0]
+    df_new = part[0]
     
     return df_old, df_new
 
 ################################################################################################
 
+def segment_metrics(df, actuals, segment_col, pred_cols, n_boot = 0):
+    '''
+    regression_metrics for each segment of df (i.e. by 'built_before_1978' or 'clusters_locationprice'), 
+    using partition so the segments aren't copied out of the frame one by one.
+    actuals = target column name in df, pred_cols = prediction columns (i.e. models plus 'baseline')
+    Returns a dataframe indexed by (segment, prediction column) with rows, rmse, mae, r2 (and intervals with n_boot)
+    '''
+    part = partition(df, segment_col)
+    
+    y = part.take(df[actuals].to_numpy(dtype=np.float64))
+    preds = pd.DataFrame(part.take(df[pred_cols].to_numpy(dtype=np.float64)), columns=pred_cols)
+    
+    results = {}
+    for key, start, end in part.slices():
+        metrics = regression_metrics(preds.iloc[start:end], y[start:end], pred_cols, n_boot = n_boot)
+        metrics.insert(0, 'rows', end - start)
+        results[key] = metrics
+    
+    return pd.concat(results, names=[segment_col, 'model'])
+
+################################################################################################
+
+def _fit_segment(key, model, X, y):
+    '''
+    Fits one segment's model for SegmentModel (runs in a worker process)
+    '''
+    return key, model.fit(X, y)
+
+################################################################################################
+
+class SegmentModel:
+    '''
+    One model per segment (i.e. per clusters_locationprice cluster, or old vs new homes), trained in parallel.
+    estimator = unfitted model, each segment gets its own clone
+    segment_col = column to split on, X_cols = feature columns
+    min_rows = segments with fewer train rows than this use the fallback model instead of their own
+    n_jobs = worker processes for fitting (-1 = one per core)
+    A fallback model fit on all the rows covers small segments and segments that weren't in train.
+    The features are pulled out once and sorted by segment (see partition), so every segment is a slice of that one block,
+    the full dataframe is never copied per segment. predict routes every row to its model in one grouped pass.
+    '''
+    def __init__(self, estimator, segment_col, X_cols, min_rows = 30, n_jobs = -1):
+        self.estimator = estimator
+        self.segment_col = segment_col
+        self.X_cols = list(X_cols)
+        self.min_rows = min_rows
+        self.n_jobs = n_jobs
+    
+    def fit(self, df, y_col):
+        '''
+        Fits the fallback model and one model per segment with at least min_rows rows. Returns the SegmentModel
+        '''
+        part = partition(df, self.segment_col)
+        
+        X = part.take(df[self.X_cols].to_numpy(dtype=np.float64))
+        y = part.take(df[y_col].to_numpy(dtype=np.float64))
+        
+        self.sizes_ = part.sizes()
+        
+        # fallback goes in with the segments, everything fits at the same time
+        jobs = [(None, X, y)] + [(key, X[start:end], y[start:end]) for key, start, end in part.slices() 
+                                 if end - start >= self.min_rows]
+        
+        fitted = Parallel(n_jobs=self.n_jobs)(delayed(_fit_segment)(key, clone(self.estimator), X_seg, y_seg) 
+                                              for key, X_seg, y_seg in jobs)
+        
+        self.models_ = dict(fitted)
+        self.fallback_ = self.models_.pop(None)
+        
+        return self
+    
+    def predict(self, df):
+        '''
+        Returns an array of predictions lined up with df, each row predicted by its segment's model
+        '''
+        part = partition(df, self.segment_col)
+        
+        X = part.take(df[self.X_cols].to_numpy(dtype=np.float64))
+        predictions = np.empty(len(X), dtype=np.float64)
+        
+        for key, start, end in part.slices():
+            model = self.models_.get(key, self.fallback_)
+            predictions[part.order[start:end]] = model.predict(X[start:end])
+        
+        return predictions
+
+################################################################################################
+
 # maybe in the future add creating the preditions and the residuals if none were entered 
 # have to import sklearn stuff
 
-def plot_the_dots(actuals, predictions, residuals):
+def plot_the_dots(actuals, predictions, residuals, plot_mode = 'auto', save_path = None):
     '''
     This function takes in the actuals (i.e. df.actuals), predictions, and residuals and outputs two graphs.
     One to see the regression line and the actuals/predictions
     One to see the actuals vs the residuals.
+    plot_mode = 'auto' (default) plots every point up to explore.LARGE_N rows, hexbins above that.
+                'scatter', 'hexbin' or 'sample' (explore.tail_sample) to pick
+    save_path = optional file to save to instead of showing it (see explore.headless for batch runs)
     '''
     
-    r_sq = r2_score(actuals, predictions)
-    rmse = mean_squared_error(actuals, predictions, squared = False)
+    metrics = regression_metrics(pd.DataFrame({'prediction': np.asarray(predictions)}), actuals).iloc[0]
+    r_sq, rmse = metrics.r2, metrics.rmse
+    
+    plot_mode = resolve_plot_mode(len(actuals), plot_mode)
     
     text_loc = actuals.max() - 2
     
+    # the 1 to 1 line only needs its two ends
+    ends = np.array([actuals.min(), actuals.max()])
+    
     # plots actual vs predicted
     plt.figure(figsize=(16, 7))
     ax = plt.subplot(1, 2, 1)
-    ax.scatter(actuals, predictions, label='predicted')
+    draw_points(ax, actuals, predictions, plot_mode, label='predicted')
     ax.set(title='Actual vs Predicted Value', ylabel='Prediction', xlabel='Actual')
-    ax.plot(actuals, actuals, ls=':', c='gray')
+    ax.plot(ends, ends, ls=':', c='gray')
     ax.text(text_loc, 1, f'R^2: {r_sq:.2f}', fontsize='large')
     
     #put r^2 value on graph
     # and rmse and rmse of baseline
     
     ax = plt.subplot(1, 2, 2)
-    ax.scatter(actuals, residuals)
+    draw_points(ax, actuals, residuals, plot_mode)
     ax.set(title = 'Actual vs Residual',ylabel='Residual', xlabel='Actual')
     ax.hlines(0, *ax.get_xlim(), ls=':', color='gray')
     ax.text(text_loc, -3, f'RMSE: {rmse:.2f}')
+    
+    if save_path is not None:
+        finish_plot(save_path)
 
 
 ################################################################################################
@@ -3,7 +3,8 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from sklearn.cluster import KMeans 
+
+import cluster
 
 #####################
 
@@ -43,17 +44,126 @@ def plot_boxes(df, figsize = (4,2)):
         else:
             print(f'{col} is an object type')
 
+##################### Big data plotting helpers
+
+# above this many rows the plotting functions stop drawing every point (plot_mode = 'auto')
+LARGE_N = 20_000
+
+def headless():
+    '''
+    Switches matplotlib to the Agg backend (no windows, no notebook output) for making reports in a batch job.
+    Pair it with save_path on the plotting functions.
+    '''
+    plt.switch_backend('Agg')
+
+
+def resolve_plot_mode(n_rows, plot_mode = 'auto', large_mode = 'hexbin'):
+    '''
+    plot_mode = 'auto', 'scatter', 'hexbin' or 'sample'. 
+    'auto' is 'scatter' up to LARGE_N rows and large_mode above that
+    '''
+    if plot_mode not in ('auto', 'scatter', 'hexbin', 'sample'):
+        raise ValueError(f"plot_mode must be 'auto', 'scatter', 'hexbin' or 'sample', got {plot_mode}")
+    
+    if plot_mode == 'auto':
+        return large_mode if n_rows > LARGE_N else 'scatter'
+    
+    return plot_mode
+
+
+def tail_sample(df, cols, n = LARGE_N // 4, tail = .005, strata = None, random_state = 713):
+    '''
+    Smaller version of df for plotting that still shows the extremes.
+    Keeps every row in the top or bottom tail (share of rows) of any of cols,
+    plus a random sample of the rest, n rows total-ish.
+    strata = optional column to sample within (i.e. a cluster column), so every group keeps its share of rows
+    '''
+    if len(df) <= n:
+        return df
+    
+    block = df[cols]
+    low, high = block.quantile(tail), block.quantile(1 - tail)
+    in_tail = ((block < low) | (block > high)).any(axis=1).to_numpy()
+    
+    # rows are picked by position, so duplicate index labels can't pull in extra rows
+    rest_positions = np.flatnonzero(~in_tail)
+    rest = df.iloc[rest_positions].reset_index(drop=True)
+    frac = min(1, max(n - in_tail.sum(), 0) / max(len(rest), 1))
+    
+    if strata is None:
+        sample = rest.sample(frac=frac, random_state=random_state)
+    else:
+        sample = rest.groupby(strata, observed=True, group_keys=False).sample(frac=frac, random_state=random_state)
+    
+    keep = in_tail.copy()
+    keep[rest_positions[sample.index.to_numpy()]] = True
+    
+    # back in the original row order
+    return df.iloc[np.flatnonzero(keep)]
+
+
+def draw_points(ax, x, y, plot_mode, **kwargs):
+    '''
+    Draws x vs y on ax as a scatter (every point, or a tail_sample for 'sample') 
+    or a hexbin image for 'hexbin' (log color scale, so sparse areas still show up)
+    Extra keyword arguments go to ax.scatter
+    '''
+    x, y = pd.Series(np.asarray(x, dtype=np.float64)), pd.Series(np.asarray(y, dtype=np.float64))
+    
+    if plot_mode == 'hexbin':
+        return ax.hexbin(x, y, gridsize=80, mincnt=1, bins='log', cmap='Blues')
+    
+    if plot_mode == 'sample':
+        points = tail_sample(pd.DataFrame({'x': x, 'y': y}), ['x', 'y'])
+        x, y = points.x, points.y
+    
+    return ax.scatter(x, y, **kwargs)
+
+
+def finish_plot(save_path = None, name = None):
+    '''
+    Shows the current figure, or saves it to save_path and closes it (for headless runs).
+    name = optional name (i.e. the variable) filled in for {name} in save_path
+    '''
+    if save_path is None:
+        plt.show()
+        return
+    
+    plt.savefig(save_path.format(name=name), bbox_inches='tight')
+    plt.close()
+
+
 ##################### plot variables against a the target
 
-def plot_against_target(df, target, var_list, figsize = (10,5), hue = None):
+def plot_against_target(df, target, var_list, figsize = (10,5), hue = None, plot_mode = 'auto', save_path = None):
     '''
     Takes in dataframe, target and varialbe list, and plots against target. 
+    plot_mode = 'auto' (default) plots every point up to LARGE_N rows, hexbins above that.
+                'scatter', 'hexbin' or 'sample' (tail_sample) to pick. 
+                Outside 'scatter' the regression line is a straight least squares fit on every row, with no bootstrap band
+    save_path = optional file to save each plot to instead of showing it, put {name} in it for the variable
+                i.e. 'plots/{name}_vs_target.png'
     '''
+    plot_mode = resolve_plot_mode(len(df), plot_mode)
+    
     for var in var_list:
         plt.figure(figsize = (figsize))
-        sns.regplot(data = df, x = var, y = target, 
-                    line_kws={'color': 'orange'})
-        plt.show()
+        
+        if plot_mode == 'scatter':
+            sns.regplot(data = df, x = var, y = target, 
+                        line_kws={'color': 'orange'})
+        else:
+            ax = plt.gca()
+            draw_points(ax, df[var], df[target], plot_mode, alpha = .5)
+            
+            # the line from all the data, only two points to draw
+            data = df[[var, target]].dropna().to_numpy(dtype=np.float64)
+            slope, intercept = np.polyfit(data[:, 0], data[:, 1], 1)
+            ends = np.array([data[:, 0].min(), data[:, 0].max()])
+            ax.plot(ends, slope * ends + intercept, color = 'orange')
+            ax.set(xlabel = var, ylabel = target)
+        
+        finish_plot(save_path, var)
 
 ##################### A scaler for exploring
 
@@ -75,39 +185,49 @@ def scale_this(X_df, scalertype):
 
 ##################### A cluster function for exploring and when you need centroids
 
-def makin_clusters(X_df, k, col_name = None ):
+def makin_clusters(X_df, k, col_name = None, backend = 'kmeans', n_threads = None):
     '''
     Function takes in scaled dataframe, k number of clusters you want to make
     Optional arguemenet col_name, If none is entered column returned is {k}_k_clusters
+    Optional backend: 'kmeans' (default), 'minibatch' or 'incremental' for big data (see cluster.py)
+    Optional n_threads: limit on threads used for the fit
     Returns dataframe with column attched and dataframe with centroids (scaled) in it
     Returns: X_df, centroids_scaled, kmeans
     Use for exploring and when you need centroids
     '''
     
-    #make thing
-    kmeans = KMeans(n_clusters=k, random_state=713)
-
-    #Fit Thing
-    kmeans.fit(X_df)
+    #make thing and Fit Thing
+    kmeans = cluster.fit_clusters(X_df, k, backend = backend, n_threads = n_threads)
     
     # create clusters
     centroids_scaled = pd.DataFrame(kmeans.cluster_centers_, columns = list(X_df))
     
+    # labels from the fit, no need to predict again
+    labels = cluster.train_labels(kmeans, X_df, backend, n_threads)
+    
     if col_name == None:
         #clusters on dataframe 
-        X_df['clusters'] = kmeans.predict(X_df)
+        X_df['clusters'] = labels
     else:
-        X_df[col_name] = kmeans.predict(X_df)
+        X_df[col_name] = labels
         
     
     return X_df, centroids_scaled, kmeans
 
 ##################### Plot clusters
 
-def plot_clusters(x ,y, cluster_col_name, df , kmeans, scaler, centroids):
+def plot_clusters(x ,y, cluster_col_name, df , kmeans, scaler, centroids, plot_mode = 'auto', save_path = None):
     
     """ Takes in x and y (variable names as strings, along with returned objects from previous
-    function create_cluster and creates a plot"""
+    function create_cluster and creates a plot
+    plot_mode = 'auto' (default) plots every point up to LARGE_N rows, above that a tail_sample 
+                taken within each cluster (so every cluster keeps its share and the edges still show).
+                'scatter' or 'sample' to pick ('hexbin' can't show the clusters, so it plots the sample too)
+    save_path = optional file to save to instead of showing it"""
+    # big data gets the per cluster sample
+    if resolve_plot_mode(len(df), plot_mode, large_mode = 'sample') != 'scatter':
+        df = tail_sample(df, [x, y], strata = cluster_col_name)
+
     # set palette to zillow colors
     zpalette = ['#1277e1', '#f3ad35', '#0b449c', '#5289e4', '#c3eafb']
 
@@ -115,27 +235,61 @@ def plot_clusters(x ,y, cluster_col_name, df , kmeans, scaler, centroids):
     plt.figure(figsize=(10, 6))
     
     # scatterplot the clusters 
-    sns.scatterplot(x = x, y = y, data = df, hue = cluster_col_name, cmap = zpalette)
+    # (palette, not cmap: cmap isn't a scatterplot argument, newer seaborn passes it on to the legend and errors out)
+    # (repeated / cut to the number of clusters, same colors seaborn would pick but without the length warning)
+    n_clusters = df[cluster_col_name].nunique()
+    sns.scatterplot(x = x, y = y, data = df, hue = cluster_col_name, palette = (zpalette * n_clusters)[:n_clusters])
     
     # plot the centroids as Xs
     centroids.plot.scatter(y=y, x= x, ax=plt.gca(), alpha=.60, s=500, c='black', marker = 'x')
+    
+    if save_path is not None:
+        finish_plot(save_path)
 
 
 ##################### Inertia plotter
 
-def plot_inertia(X_df, k_range_start = 2, k_range_end = 10):
+def plot_inertia(X_df = None, k_range_start = 2, k_range_end = 10, sweep = None, scores = False, return_sweep = False, **sweep_kwargs):
     '''
     This function takes in a dataframe (scaled)
     And plots the change in inertia 
     Optional argument to change the range
+    The k's are fit in parallel and cached by cluster.k_sweep (seed 713), so plotting the same data again is instant.
+    Optional sweep: results from cluster.k_sweep to plot directly instead of X_df
+    Optional scores: True to also plot the silhouette and Calinski-Harabasz scores
+    Optional return_sweep: True to get the sweep results dataframe back (with the fitted models), nothing is returned otherwise
+    Any other keyword arguments (sample_size, max_workers, backend...) get passed to cluster.k_sweep
     '''
-    with plt.style.context('seaborn-whitegrid'):
-        plt.figure(figsize=(9, 6))
-        pd.Series({k: KMeans(k).fit(X_df).inertia_ for k in range(k_range_start, k_range_end)}).plot(marker='x')
-        plt.xticks(range(k_range_start -1, k_range_end))
-        plt.xlabel('k')
-        plt.ylabel('inertia')
-        plt.title('Change in inertia as k increases')
+    if sweep is None:
+        sweep = cluster.k_sweep(X_df, range(k_range_start, k_range_end), **sweep_kwargs)
+
+    # style got renamed in newer matplotlib
+    style = 'seaborn-whitegrid' if 'seaborn-whitegrid' in plt.style.available else 'seaborn-v0_8-whitegrid'
+
+    with plt.style.context(style):
+
+        if scores:
+            fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+        else:
+            plt.figure(figsize=(9, 6))
+            axes = [plt.gca()]
+
+        sweep.inertia.plot(marker='x', ax=axes[0])
+        axes[0].set_xticks(range(sweep.index.min() - 1, sweep.index.max() + 1))
+        axes[0].set_xlabel('k')
+        axes[0].set_ylabel('inertia')
+        axes[0].set_title('Change in inertia as k increases')
+
+        if scores:
+            for ax, col, title in zip(axes[1:], ['silhouette', 'calinski_harabasz'], ['Silhouette score (higher is better)', 'Calinski-Harabasz score (higher is better)']):
+                sweep[col].plot(marker='x', ax=ax)
+                ax.set_xticks(sweep.index)
+                ax.set_xlabel('k')
+                ax.set_ylabel(col)
+                ax.set_title(title)
+
+    if return_sweep:
+        return sweep
 
 #####################
 
@@ -10,13 +10,26 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 import scipy.stats as stats
-from sklearn.model_selection import train_test_split
+import scipy.sparse
+from sklearn.model_selection import train_test_split, KFold, StratifiedKFold
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from sklearn.cluster import KMeans 
 
 # defining some functions to make it easier. will go in Wrangle function
 from env import host, password, user
 import os
+import json
+import inspect
+import time
+import shutil
+import tracemalloc
+from collections import namedtuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+import cache
+import cluster
 
 ###################### Getting database Url ################
 def get_db_url(db_name, user=user, host=host, password=password):
@@ -27,21 +40,295 @@ def get_db_url(db_name, user=user, host=host, password=password):
     url = f'mysql+pymysql://{user}:{password}@{host}/{db_name}'
     return url
 
+######################### pooled engines #########################
+
+# one pooled engine per database name, so repeat calls reuse open connections
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_engine(database, url=None, pool_size=5):
+    '''
+    Returns the pooled sqlalchemy engine for a database, it is only created the first time.
+    url = optional url to use instead of get_db_url(database). 
+    For testing without the Codeup server register a local stand in before anything else runs,
+    i.e. get_engine('zillow', url='sqlite:///zillow_test.db')
+    pool_size = number of connections kept open in the pool (ignored by sqlite)
+    Raises ValueError if url is given and the database already has an engine for a different url
+    (call dispose_engines first to switch), so a test stand in never quietly ends up on the real database.
+    '''
+    with _engines_lock:
+        
+        if database in _engines and url is not None and make_url(url) != _engines[database].url:
+            raise ValueError(f'{database} already has an engine for a different url, call dispose_engines() first to switch')
+        
+        if database not in _engines:
+            
+            url = url or get_db_url(database)
+            
+            # sqlite has its own pool and doesn't take a size
+            pool_kwargs = {} if url.startswith('sqlite') else {'pool_size': pool_size, 'pool_recycle': 3600}
+            
+            _engines[database] = create_engine(url, pool_pre_ping=True, **pool_kwargs)
+            
+        return _engines[database]
+
+#########################
+
+def dispose_engines():
+    '''
+    Closes all pooled connections and forgets the engines. Next call to get_engine makes a new one.
+    '''
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
 ######################### get generic data #########################
-def get_any_data(database, sql_query):
+def get_any_data(database, sql_query, chunksize=None, use_cache=False, cache_format='parquet'):
     '''
     put in the query and the database and get the data you need in a dataframe
+    Optional chunksize: if given, returns a generator of dataframes (chunksize rows each) 
+    instead of one big dataframe, same as pd.read_sql does. See stream_any_data. Streams aren't cached.
+    use_cache = if True results are kept in the cache folder, keyed by the database and SQL text,
+    so running the same query again reads it from disk and a different query never gets old data.
+    Default is False, every call goes to the database same as always
+    cache_format = 'parquet' (default) or 'csv'
     '''
+    if chunksize is not None:
+        return stream_any_data(database, sql_query, chunksize=chunksize)
+    
+    if not use_cache:
+        return pd.read_sql(sql_query, get_engine(database))
+    
+    cache_file = cache.cache_path(cache.query_key(database, sql_query), cache_format)
+    
+    if not cache.lookup(cache_file):
+        
+        write_cache(pd.read_sql(sql_query, get_engine(database)), cache_file)
+        
+        # make room if the cache folder got too big
+        cache.evict(keep=[cache_file])
+    
+    return read_cache(cache_file)
 
-    return pd.read_sql(sql_query, get_db_url(database))
+#########################
 
-######################### get Zillow Data #########################
-def get_zillow_data():
+def get_many_data(database, queries, max_workers=4):
     '''
-    This function reads in Zillow data from Codeup database, writes data to
-    a csv file if a local file does not exist, and returns a df.
+    Runs several queries at the same time on a thread pool, all through the pooled engine for the database.
+    queries = dictionary of {name: sql_query}
+    max_workers = how many queries can run at once (keep it at or below the engine's pool_size)
+    Returns a dictionary of {name: dataframe}
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        
+        # start every query, then collect them in the same order they were given
+        futures = {name: pool.submit(get_any_data, database, sql_query) for name, sql_query in queries.items()}
+        
+        return {name: future.result() for name, future in futures.items()}
+
+######################### stream generic data #########################
+def stream_any_data(database, sql_query, chunksize=50_000):
+    '''
+    Generator version of get_any_data. Uses a server side cursor so only one chunk 
+    of the result is in memory at a time.
+    chunksize = number of rows per dataframe yielded
+    Chunk indexes continue on from each other, so pd.concat of all the chunks 
+    looks the same as what get_any_data returns.
+    '''
+    # stream_results makes the driver use a server side (unbuffered) cursor
+    with get_engine(database).connect().execution_options(stream_results=True) as conn:
+        
+        # keep track of where the next chunk's index starts
+        offset = 0
+        
+        for chunk in pd.read_sql(sql_query, conn, chunksize=chunksize):
+            
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            
+            yield chunk
+
+######################### Local cache helpers #########################
+
+def _apply_filters(df, filters):
+    '''
+    Applies a list of (column, op, value) filters to a dataframe in memory.
+    Same filter format that pd.read_parquet uses, so the csv cache can take the same filters as the parquet one.
+    ops: ==, !=, <, <=, >, >=, in, not in
+    '''
+    # start with every row kept
+    mask = pd.Series(True, index=df.index)
+
+    for col, op, val in filters:
+        
+        if op in ('=', '=='):
+            mask &= df[col] == val
+        elif op == '!=':
+            mask &= df[col] != val
+        elif op == '<':
+            mask &= df[col] < val
+        elif op == '<=':
+            mask &= df[col] <= val
+        elif op == '>':
+            mask &= df[col] > val
+        elif op == '>=':
+            mask &= df[col] >= val
+        elif op == 'in':
+            mask &= df[col].isin(val)
+        elif op == 'not in':
+            mask &= ~df[col].isin(val)
+        else:
+            raise ValueError(f'Unsupported filter operator: {op}')
+
+    return df[mask]
+
+#########################
+
+def read_cache(path, columns=None, filters=None):
+    '''
+    Reads a local cache file, parquet or csv (decided by the file extension).
+    columns = optional list of columns to read (parquet only reads those columns off disk)
+    filters = optional list of (column, op, value) tuples, i.e. [('fips', '==', 6037)]
+    For parquet the filters are pushed down so row groups that can't match are skipped.
+    '''
+    if path.endswith('.parquet'):
+        
+        # parquet keeps the dtypes, and only reads the columns / row groups asked for
+        return pd.read_parquet(path, columns=columns, filters=filters)
+    
+    # legacy csv cache, has to parse the whole file
+    usecols = None
+    if columns is not None:
+        # csv index lives in the first column, filter columns have to be read too
+        filter_cols = [col for col, op, val in filters] if filters else []
+        usecols = lambda col: col in columns or col in filter_cols or col.startswith('Unnamed')
+        
+    df = pd.read_csv(path, index_col=0, usecols=usecols)
+    
+    if filters:
+        df = _apply_filters(df, filters)
+        
+    if columns is not None:
+        df = df[columns]
+    
+    return df
+
+#########################
+
+def write_cache(df, path, row_group_size=10_000):
+    '''
+    Writes a dataframe to a local cache file, parquet or csv (decided by the file extension).
+    row_group_size = rows per parquet row group, smaller groups means filters can skip more of the file
+    '''
+    if path.endswith('.parquet'):
+        # index=True stores the index as a real column, so it survives row filtering
+        df.to_parquet(path, index=True, row_group_size=row_group_size)
+    else:
+        df.to_csv(path)
+
+#########################
+
+def write_cache_chunks(chunks, path, row_group_size=10_000):
+    '''
+    Writes an iterable of dataframes (i.e. from stream_any_data) to a local cache file as they arrive,
+    so the whole table never has to be in memory. parquet or csv (decided by the file extension).
+    For parquet each chunk is written to its own part file first, then the parts are 
+    combined into one file with a schema that works for all of them 
+    (a column that is all null in one chunk and floats in another ends up as floats).
+    If there are no chunks at all an empty cache file gets written.
+    Everything goes to path.tmp first and is only moved to path once the last chunk is in,
+    so a stream that fails partway never leaves a half written file that looks like a cache hit.
+    Returns the number of rows written.
+    '''
+    rows = 0
+    tmp_path = f'{path}.tmp'
+    
+    # scratch directory for the parquet part files
+    parts_dir = f'{path}.parts'
+    
+    try:
+        if not path.endswith('.parquet'):
+            
+            # csv can just be appended to, header only on the first chunk
+            wrote = False
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=(i == 0))
+                rows += len(chunk)
+                wrote = True
+            
+            # no chunks at all (empty query result), still leave an (empty) cache file
+            if not wrote:
+                pd.DataFrame().to_csv(tmp_path)
+        
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            
+            os.makedirs(parts_dir, exist_ok=True)
+            part_paths = []
+            
+            # write each chunk out as soon as it comes in
+            for i, chunk in enumerate(chunks):
+                part_path = os.path.join(parts_dir, f'part-{i:05d}.parquet')
+                chunk.to_parquet(part_path, index=True)
+                part_paths.append(part_path)
+                rows += len(chunk)
+            
+            if part_paths:
+                
+                # only the footers get read here, not the data
+                schema = pa.unify_schemas([pq.read_schema(part) for part in part_paths], 
+                                          promote_options='permissive')
+                
+                # stitch the parts together one at a time
+                with pq.ParquetWriter(tmp_path, schema) as writer:
+                    for part_path in part_paths:
+                        writer.write_table(pq.read_table(part_path).cast(schema), row_group_size=row_group_size)
+            else:
+                # no chunks at all (empty query result), still leave an (empty) cache file
+                pd.DataFrame().to_parquet(tmp_path, index=True)
+        
+        # every chunk made it, now it can be the cache file
+        os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    
+    return rows
+
+#########################
+
+def migrate_csv_cache(csv_path, cache_file):
+    '''
+    One time migration of an old csv cache (i.e. zillow_data.csv) to a cache file.
+    Parquet targets get the csv read once and written out as parquet, csv targets just get a copy.
+    The old csv file is left where it is, with a csv_path.migrated marker next to it 
+    so it never gets copied in again (i.e. after the cache entry is evicted).
+    Returns True if a migration happened.
     '''
-    sql_query = """
+    marker = f'{csv_path}.migrated'
+    
+    # nothing to do if already migrated or if there is no csv
+    if os.path.isfile(marker) or os.path.isfile(cache_file) or not os.path.isfile(csv_path):
+        return False
+    
+    if cache_file.endswith('.parquet'):
+        write_cache(pd.read_csv(csv_path, index_col=0), cache_file)
+    else:
+        shutil.copyfile(csv_path, cache_file)
+    
+    with open(marker, 'w') as f:
+        f.write(cache_file)
+    
+    return True
+
+######################### get Zillow Data #########################
+
+# latest transaction per parcel, {delta_filter} is empty for a full pull 
+# and gets the high water mark condition for an incremental sync
+ZILLOW_SQL = """
                 SELECT parcelid, airconditioningtypeid, airconditioningdesc, architecturalstyletypeid, architecturalstyledesc,
                 bathroomcnt, bedroomcnt, buildingclasstypeid, buildingclassdesc, buildingqualitytypeid,
                 decktypeid, calculatedfinishedsquarefeet, fips, fireplacecnt, fireplaceflag, garagecarcnt, garagetotalsqft,
@@ -63,48 +350,315 @@ def get_zillow_data():
                 LEFT JOIN storytype USING (storytypeid)
                 LEFT JOIN typeconstructiontype USING (typeconstructiontypeid)
                 WHERE latitude IS NOT NULL AND longitude IS NOT NULL 
-                AND transactiondate LIKE "2017%%";
+                AND transactiondate LIKE "2017%%"{delta_filter};
                 """
-    if os.path.isfile('zillow_data.csv'):
-        
-        # If csv file exists read in data from csv file.
-        df = pd.read_csv('zillow_data.csv', index_col=0)
+
+# cache key of the query the old zillow_data.csv was pulled with (the original get_zillow_data SQL, schema version 1).
+# The csv only ever gets migrated to this key, never to the key of an edited query
+LEGACY_ZILLOW_KEY = 'd32e6b11dd252ba2060eea97fdae71920291a21603dbe56a4be045e743c3e39c'
+
+def zillow_cache_path(cache_format='parquet'):
+    '''
+    Path of the Zillow cache file, named by the hash of the database, ZILLOW_SQL and cache.SCHEMA_VERSION
+    '''
+    return cache.cache_path(cache.query_key('zillow', ZILLOW_SQL.format(delta_filter='')), cache_format)
+
+#########################
+
+def get_zillow_data(cache_format='parquet', columns=None, filters=None, chunksize=None, refresh=False):
+    '''
+    This function reads in Zillow data from Codeup database, writes data to
+    a local cache file if one does not exist, and returns a df.
+    cache_format = 'parquet' (default, keeps dtypes) or 'csv' (legacy zillow_data.csv)
+    columns = optional list of columns to read from the cache, i.e. ['latitude', 'longitude', 'taxvaluedollarcnt']
+    filters = optional list of (column, op, value) tuples, i.e. [('fips', '==', 6037)]
+    chunksize = optional, if given a fresh pull from the database is streamed into the cache
+    chunksize rows at a time instead of being held in memory all at once
+    refresh = if True, an existing cache is brought up to date with sync_zillow_data first 
+    (only transactions newer than the last sync are pulled)
+    The cache file lives in the cache folder and is named by a hash of the query (see zillow_cache_path),
+    so editing ZILLOW_SQL means a fresh pull instead of old data.
+    An existing zillow_data.csv gets migrated into the cache folder once, 
+    and only while ZILLOW_SQL is still the query it was pulled with.
+    '''
+    # the full query, no delta filter
+    sql_query = ZILLOW_SQL.format(delta_filter='')
+    
+    # local cache file name
+    cache_file = zillow_cache_path(cache_format)
+    
+    # one time move over from the old csv cache, only if it was made by this same query
+    if os.path.basename(cache_file).split('.')[0] == LEGACY_ZILLOW_KEY:
+        migrate_csv_cache('zillow_data.csv', cache_file)
+    
+    cache_hit = cache.lookup(cache_file)
+    
+    if not cache_hit and chunksize is not None:
         
-    else:
+        # Stream fresh data from db straight into the cache, one chunk at a time
+        write_cache_chunks(stream_any_data('zillow', sql_query, chunksize=chunksize), cache_file)
+        cache.evict(keep=[cache_file])
+    
+    elif not cache_hit:
         
         # Read fresh data from db into a DataFrame
-        df = pd.read_sql(sql_query, get_db_url('zillow'))
+        df = get_any_data('zillow', sql_query, use_cache=False)
         
         # Cache data
-        df.to_csv('zillow_data.csv')
+        write_cache(df, cache_file)
+        cache.evict(keep=[cache_file])
+    
+    elif refresh:
+        
+        # pull only the new transactions and merge them in
+        sync_zillow_data(cache_file, chunksize=chunksize)
+        
+    # read from the cache, only the columns and rows asked for
+    df = read_cache(cache_file, columns=columns, filters=filters)
 
     return df
 
+######################### Incremental sync #########################
+
+def _sync_meta_path(cache_file):
+    '''
+    Name of the json file that stores the high water mark next to a cache file
+    '''
+    return f'{os.path.splitext(cache_file)[0]}.sync.json'
+
+#########################
+
+def zillow_high_water_mark(df):
+    '''
+    Takes in Zillow data (needs transactiondate and parcelid columns) 
+    and returns the newest transactiondate and the biggest parcelid on that date as a dictionary
+    '''
+    dates = pd.to_datetime(df['transactiondate'])
+    
+    latest = dates.max()
+    
+    return {'transactiondate': latest.strftime('%Y-%m-%d'), 
+            'parcelid': int(df.loc[dates == latest, 'parcelid'].max())}
+
+#########################
+
+def merge_zillow_delta(df, delta):
+    '''
+    Merges newly pulled rows (delta) into the cached Zillow data (df).
+    Keeps the latest transaction per parcel the same way the MAX(transactiondate) subquery does:
+    if a parcel shows up in the delta it has a newer transaction, so its old rows get replaced.
+    New rows get index values that continue on from the cache.
+    '''
+    # match the cached transactiondate format (csv migrated caches have it as text)
+    if len(df) and isinstance(df['transactiondate'].iloc[0], str):
+        delta = delta.assign(transactiondate=delta['transactiondate'].astype(str))
+    
+    # old rows for parcels that have a newer transaction now
+    df = df[~df['parcelid'].isin(delta['parcelid'])]
+    
+    # continue the index on from the cache
+    start = df.index.max() + 1 if len(df) else 0
+    delta = delta.set_axis(pd.RangeIndex(start, start + len(delta)))
+    
+    return pd.concat([df, delta])
+
+#########################
+
+def sync_zillow_data(cache_file=None, chunksize=None):
+    '''
+    Incremental refresh of the Zillow cache.
+    Reads the high water mark (transactiondate, parcelid) from the last sync, 
+    pulls only the transactions after it, merges them into the cache and records the new high water mark.
+    If there was never a sync before the high water mark is worked out from the cache itself.
+    cache_file = defaults to the parquet file from zillow_cache_path
+    Returns the number of rows pulled.
+    '''
+    if cache_file is None:
+        cache_file = zillow_cache_path()
+    
+    meta_path = _sync_meta_path(cache_file)
+    
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            mark = json.load(f)
+    else:
+        mark = zillow_high_water_mark(read_cache(cache_file, columns=['transactiondate', 'parcelid']))
+    
+    # only transactions after the high water mark, the mark goes in as bound parameters
+    delta_filter = """
+                AND (transactiondate > :mark_date
+                OR (transactiondate = :mark_date AND parcelid > :mark_parcelid))"""
+    
+    sql_query = text(ZILLOW_SQL.format(delta_filter=delta_filter)).bindparams(
+        mark_date=str(mark['transactiondate']), mark_parcelid=int(mark['parcelid']))
+    
+    if chunksize is not None:
+        deltas = stream_any_data('zillow', sql_query, chunksize=chunksize)
+    else:
+        deltas = [get_any_data('zillow', sql_query, use_cache=False)]
+    
+    # merge one chunk at a time, the delta is never all in memory at once
+    df = None
+    pulled = 0
+    
+    for delta in deltas:
+        
+        if not len(delta):
+            continue
+        
+        df = merge_zillow_delta(read_cache(cache_file) if df is None else df, delta)
+        pulled += len(delta)
+    
+    if pulled:
+        
+        # rewrite the cache
+        write_cache(df, cache_file)
+        
+        mark = zillow_high_water_mark(df)
+    
+    # record when and where this sync left off
+    mark['synced_at'] = pd.Timestamp.now().isoformat()
+    with open(meta_path, 'w') as f:
+        json.dump(mark, f)
+    
+    return pulled
+
+######################### Profiling #########################
+
+# what profile_frame returns
+# summary = dataframe, one row per column: dtype, n_unique, approx_unique, n_null, pct_null
+# value_counts = dictionary of {column: value counts series} for the columns overview prints counts for
+DataProfile = namedtuple('DataProfile', ['summary', 'value_counts'])
+
+#########################
+
+def approx_distinct(s, p = 14):
+    '''
+    HyperLogLog estimate of the number of unique non null values in a series.
+    Uses 2**p registers (p = 14 is about 16k registers, roughly 1 percent error) and 
+    one vectorized hash of the column, so memory doesn't grow with the number of unique values.
+    '''
+    hashes = pd.util.hash_pandas_object(s.dropna(), index=False).to_numpy()
+    
+    if len(hashes) == 0:
+        return 0
+    
+    m = 1 << p
+    
+    # first p bits pick the register, the rest get their leading zeros counted
+    register = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - p)) - 1)
+    
+    # bit length from the float exponent (exact, the rest fits in a float's 53 bits)
+    bit_length = np.frexp(rest.astype(np.float64))[1]
+    rank = (64 - p) - bit_length + 1
+    
+    registers = np.zeros(m, dtype=np.int64)
+    np.maximum.at(registers, register, rank)
+    
+    # raw estimate, with the small range correction
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(2.0 ** -registers)
+    
+    empty = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and empty:
+        estimate = m * np.log(m / empty)
+    
+    return int(round(estimate))
+
+#########################
+
+def _binned_counts(counts, bins = 10):
+    '''
+    Turns exact value counts of a numeric column into the same counts value_counts(bins=bins) gives,
+    by binning the unique values (same min and max, so same edges) and adding up their counts
+    '''
+    binned = pd.cut(counts.index, bins, include_lowest=True)
+    
+    return counts.groupby(binned, observed=False).sum().rename('count').sort_index(ascending = True)
+
+#########################
+
+def profile_frame(df, thresh = 10, max_binned = 150, bins = 10, approx = 'auto', approx_min_rows = 1_000_000):
+    '''
+    Profiles every column of a dataframe with one value_counts pass per column, 
+    everything else (unique count, null count, exact or binned counts) comes from that.
+    thresh = columns with this many unique values or fewer get exact value counts
+    max_binned = numeric columns with fewer unique values than this get binned value counts
+    bins = number of bins
+    approx = True uses approx_distinct (HyperLogLog) first and skips the exact pass for columns that clearly 
+             have too many unique values to need counts. 'auto' (default) only does that for dataframes with at 
+             least approx_min_rows rows. False is always exact.
+    Returns a DataProfile with a summary dataframe and a dictionary of value counts
+    '''
+    use_approx = approx is True or (approx == 'auto' and len(df) >= approx_min_rows)
+    
+    rows = {}
+    value_counts = {}
+    
+    for col in df.columns:
+        
+        s = df[col]
+        
+        # HyperLogLog first, columns with way more unique values than max_binned never need counts
+        if use_approx:
+            estimate = approx_distinct(s)
+            
+            if estimate > 2 * max_binned:
+                n_null = int(s.isnull().sum())
+                rows[col] = {'dtype': str(s.dtype), 'n_unique': estimate, 'approx_unique': True, 
+                             'n_null': n_null, 'pct_null': 100 * n_null / len(df) if len(df) else 0.0}
+                continue
+        
+        # the one pass: counts of every value, nulls included
+        counts = s.value_counts(dropna = False)
+        
+        # categoricals list the categories that never show up too
+        counts = counts[counts > 0]
+        
+        is_null = counts.index.isna()
+        n_null = int(counts[is_null].sum())
+        n_unique = int(len(counts) - is_null.sum())
+        
+        rows[col] = {'dtype': str(s.dtype), 'n_unique': n_unique, 'approx_unique': False, 
+                     'n_null': n_null, 'pct_null': 100 * n_null / len(df) if len(df) else 0.0}
+        
+        # if number of things is under or equal to the threshold keep the value counts
+        if n_unique <= thresh:
+            value_counts[col] = counts.sort_index(ascending = True)
+        
+        # if the number is less than max_binned and numeric, bin it
+        elif n_unique < max_binned and pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            value_counts[col] = _binned_counts(counts[~is_null], bins)
+    
+    summary = pd.DataFrame.from_dict(rows, orient = 'index')
+    
+    return DataProfile(summary, value_counts)
+
 ######################### Overview #########################
-def overview(df, thresh = 10):
+def overview(df, thresh = 10, report = None):
     '''
     This function takes in a dataframe and prints out useful things about each column.
     Unique values, value counts for columns less than 10 (can be adjusted with optional arguement thresh)
     Whether or not the row has nulls
+    Optional report: a DataProfile from profile_frame to print instead of profiling df again
+    (profile_frame is where the numbers come from, use it directly to keep them)
     '''
-    # create list of columns
-    col_list = df.columns
+    if report is None:
+        report = profile_frame(df, thresh = thresh)
     
     # loop through column list
-    for col in col_list:
+    for col in report.summary.index:
         # seperator using column name
         print(f'============== {col} ==============')
         
         # print out unique values for each column
-        print(f'# Unique Vals: {df[col].nunique()}')
+        approx = '~' if report.summary.loc[col, 'approx_unique'] else ''
+        print(f"# Unique Vals: {approx}{report.summary.loc[col, 'n_unique']}")
         
-        # if number of things is under or equal to the threshold  print a value counts
-        if df[col].nunique() <= thresh:
-            print(df[col].value_counts(dropna = False).sort_index(ascending = True))
-            
-        # if the number is less than 150 and not an object, bin it and do value counts
-        elif (df[col].nunique() < 150) and df[col].dtype != 'object' :
-            print(df[col].value_counts(bins = 10, dropna=False).sort_index(ascending = True))
+        # exact counts for low unique columns, binned counts for the numeric ones under 150
+        if col in report.value_counts:
+            print(report.value_counts[col])
         
         # Space for readability 
         print('')
@@ -112,16 +666,113 @@ def overview(df, thresh = 10):
 
 #########################
 
+######################### Null masks #########################
+
+# number of 1 bits in every possible byte, for counting nulls without unpacking
+_BIT_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+class NullMask:
+    '''
+    Bit packed null mask of a dataframe, one bit per cell (8 rows per byte, per column), 
+    so it takes 1/8 the memory of df.isnull().
+    Get one with null_mask(df).
+    col_null_counts / row_null_counts / row_histogram answer the usual null questions,
+    take_rows / select_columns give the mask for a dataframe with rows or columns dropped without going back to the data.
+    '''
+    def __init__(self, packed, n_rows, columns, index):
+        # packed is (number of columns, ceil(n_rows / 8)) uint8
+        self.packed = packed
+        self.n_rows = n_rows
+        self.columns = columns
+        self.index = index
+    
+    @classmethod
+    def from_frame(cls, df):
+        '''
+        Builds the mask one column at a time, the full isnull() matrix is never in memory
+        '''
+        packed = np.zeros((df.shape[1], (len(df) + 7) // 8), dtype=np.uint8)
+        
+        for j in range(df.shape[1]):
+            packed[j] = np.packbits(df.iloc[:, j].isnull().to_numpy())
+        
+        return cls(packed, len(df), df.columns, df.index)
+    
+    def matches(self, df):
+        '''
+        True if this mask still lines up with df (same columns and index)
+        '''
+        return (len(df) == self.n_rows and (df.columns is self.columns or df.columns.equals(self.columns)) 
+                and (df.index is self.index or df.index.equals(self.index)))
+    
+    def col_null_counts(self):
+        '''
+        Series of nulls per column, same as df.isnull().sum()
+        '''
+        return pd.Series(_BIT_COUNTS[self.packed].sum(axis=1), index=self.columns)
+    
+    def row_null_counts(self):
+        '''
+        Array of nulls per row, same as df.isnull().sum(axis=1).to_numpy()
+        '''
+        counts = np.zeros(self.n_rows, dtype=np.int64)
+        
+        # one column at a time keeps memory down
+        for row_bits in self.packed:
+            counts += np.unpackbits(row_bits, count=self.n_rows)
+        
+        return counts
+    
+    def row_histogram(self):
+        '''
+        Array where position i is how many rows have exactly i nulls
+        '''
+        return np.bincount(self.row_null_counts(), minlength=len(self.columns) + 1)
+    
+    def select_columns(self, cols):
+        '''
+        Mask for the same rows but only these columns (a list of names or a boolean array)
+        '''
+        if isinstance(cols, np.ndarray) and cols.dtype == bool:
+            positions = np.flatnonzero(cols)
+        else:
+            positions = self.columns.get_indexer(cols)
+        
+        return NullMask(self.packed[positions], self.n_rows, self.columns[positions], self.index)
+    
+    def take_rows(self, keep):
+        '''
+        Mask for the rows where keep (boolean array) is True
+        '''
+        keep = np.asarray(keep, dtype=bool)
+        packed = np.zeros((len(self.columns), (keep.sum() + 7) // 8), dtype=np.uint8)
+        
+        for j, row_bits in enumerate(self.packed):
+            packed[j] = np.packbits(np.unpackbits(row_bits, count=self.n_rows)[keep])
+        
+        return NullMask(packed, int(keep.sum()), self.columns, self.index[keep])
+
+#########################
+
+def null_mask(df):
+    '''
+    Returns the NullMask for a dataframe, always worked out from the data 
+    so values changed in place show up (it's one cheap pass per column).
+    '''
+    return NullMask.from_frame(df)
+
+#########################
+
 def missing_values_table(df):
     '''
     this function takes a dataframe as input and will output metrics for missing values, 
     and the percent of that column that has missing values
     '''
     # Total missing values
-    mis_val = df.isnull().sum()
+    mis_val = null_mask(df).col_null_counts()
     
     # Percentage of missing values
-    mis_val_percent = 100 * df.isnull().sum() / len(df)
+    mis_val_percent = 100 * mis_val / len(df)
     
     # Make a table with the results
     mis_val_table = pd.concat([mis_val, mis_val_percent], axis=1)
@@ -149,34 +800,43 @@ def nulls_by_row(df):
     '''
     This function takes in a dataframe and returns a dataframe with an overview of how many rows have missing values
     '''
-    num_missing = df.isnull().sum(axis=1)
-    prcnt_miss = round(num_missing / df.shape[1] * 100, 2)
-    rows_missing = pd.DataFrame({'num_cols_missing': num_missing, 'percent_cols_missing': prcnt_miss})\
-    .reset_index()\
-    .groupby(['num_cols_missing', 'percent_cols_missing']).count()\
-    .rename(index=str, columns={'index': 'num_rows'}).reset_index()
+    # how many rows have 0, 1, 2... nulls
+    histogram = null_mask(df).row_histogram()
+    num_missing = np.flatnonzero(histogram)
+    
+    rows_missing = pd.DataFrame({'num_cols_missing': num_missing, 
+                                 'percent_cols_missing': np.round(num_missing / df.shape[1] * 100, 2),
+                                 'num_rows': histogram[num_missing]})
     return rows_missing
 
 #########################
 
-def single_homes(df):
+def single_homes_mask(df):
     '''
-    Function takes in zillow dataframe and outputs dataframe with only data for single unit homes.
-    Single unit home defined as any of the following 
-    'Single Family Residential', 'Townhouse', 'Manufactured, Modular, Prefabricated Homes', 'Mobile Home'
-    Home must also have unit count of 1 or NaN
+    Returns a boolean series, True for the rows single_homes keeps
     '''
     # define single home descriptions
     single_homes = ['Single Family Residential', 'Townhouse', 'Manufactured, Modular, Prefabricated Homes', 'Mobile Home']
     
     # If the property land use description is the in the single homes list keep it
-    df = df[df['propertylandusedesc'].isin(single_homes)]
+    landuse_mask = df['propertylandusedesc'].isin(single_homes)
     
     # create mask if unit count is 1 or NaN
     unitcnt_mask = (df['unitcnt'] == 1) | (df['unitcnt'].isnull())
     
-    # apply mask to dataframe
-    df = df[unitcnt_mask]
+    return landuse_mask & unitcnt_mask
+
+#########################
+
+def single_homes(df):
+    '''
+    Function takes in zillow dataframe and outputs dataframe with only data for single unit homes.
+    Single unit home defined as any of the following 
+    'Single Family Residential', 'Townhouse', 'Manufactured, Modular, Prefabricated Homes', 'Mobile Home'
+    Home must also have unit count of 1 or NaN
+    '''
+    # apply both masks to dataframe at once
+    df = df[single_homes_mask(df)]
     
     return df
 
@@ -188,18 +848,22 @@ def drop_missing(df, min_col_percent= 0.65, min_row_percent = 0.85):
     The minimum col percent is how many null values you would like to have in your columns for them to stay
     min_row_percent will be how many values must be not null in order to keep that row
     '''
+    mask = null_mask(df)
+    
     # calculate columns threshold (any columns that have more nulls than this, dropped)
     col_thresh = int(round(min_col_percent*df.shape[0]))
     
     # drop columns 
-    df = df.dropna(axis=1, thresh=col_thresh)
+    keep_cols = (len(df) - mask.col_null_counts()).to_numpy() >= col_thresh
+    df = df.loc[:, keep_cols]
+    mask = mask.select_columns(keep_cols)
     
     # calculate row threshold 
     row_thresh = int(round(min_row_percent * df.shape[1]))
     
     # drop rows
-    
-    df = df.dropna(axis=0, thresh=row_thresh)
+    keep_rows = (df.shape[1] - mask.row_null_counts()) >= row_thresh
+    df = df[keep_rows]
     
     return df
 
@@ -220,13 +884,24 @@ def get_house_age(df):
 #########################
 
 
-def yearbuilt_bins(df):
+def yearbuilt_edges(yearbuilt):
+    '''
+    Takes in the yearbuilt column and returns the bin edges yearbuilt_bins uses:
+    oldest year, 1978, 2000, newest year
+    '''
+    return [yearbuilt.min(), 1978, 2000, yearbuilt.max()]
+
+#########################
+
+def yearbuilt_bins(df, year_bins = None):
     '''
     Function takes in a dataframe, uses the 'yearbuilt' column to create age bins
     pre 1978, 1978-2000, and post 2000 
+    Optional year_bins: bin edges to use instead of working them out from this dataframe (see yearbuilt_edges)
     '''
     # set bin sizes
-    year_bins = [df['yearbuilt'].min(), 1978, 2000,df['yearbuilt'].max()]
+    if year_bins is None:
+        year_bins = yearbuilt_edges(df['yearbuilt'])
     
     # use cut to assign bins using yearbuilt column
     df['yearbuilt_bins'] = pd.cut(df['yearbuilt'], year_bins)
@@ -276,44 +951,92 @@ def get_tax_rate(df):
 
 #########################
 
-def remove_outliers(df, k, col_list):
+def remove_outliers(df, k, col_list, method = 'sequential', return_counts = False):
     '''
     This function takes in a dataframe, k value, and column list and 
     k = number times interquartile range you would like to remove
     col_list = names of columns you want outliers removed from
     removes outliers from a list of columns in a dataframe 
     and return that dataframe
+    method = 'sequential' (default) goes one column at a time, each column's quartiles come from 
+             what's left after the columns before it (so column order matters). Same as it always was.
+             'vectorized' gets every column's quartiles from the full dataframe in one quantile call, 
+             builds one mask and filters once. Faster, and column order doesn't matter.
+    return_counts = if True also returns a series with how many rows each column dropped.
+             For 'vectorized' a row outside the bounds of two columns counts for both.
     '''
-    
-    for col in col_list:
-
-        q1, q3 = df[f'{col}'].quantile([.25, .75])  # get quartiles
+    if method == 'vectorized':
+        
+        block = df[col_list]
+        
+        # all the quartiles in one go
+        quartiles = block.quantile([.25, .75])
+        q1, q3 = quartiles.loc[.25], quartiles.loc[.75]
         
         iqr = q3 - q1   # calculate interquartile range
         
         upper_bound = q3 + k * iqr   # get upper bound
         lower_bound = q1 - k * iqr   # get lower bound
-
-        # return dataframe without outliers
         
-        df = df[(df[f'{col}'] > lower_bound) & (df[f'{col}'] < upper_bound)]
+        # lines up the bounds with each column
+        inside = (block > lower_bound) & (block < upper_bound)
         
+        counts = (~inside).sum()
+        
+        # return dataframe without outliers, one filter
+        df = df[inside.all(axis=1)]
+    
+    elif method == 'sequential':
+        
+        counts = pd.Series(0, index=col_list)
+        
+        for col in col_list:
+    
+            q1, q3 = df[f'{col}'].quantile([.25, .75])  # get quartiles
+            
+            iqr = q3 - q1   # calculate interquartile range
+            
+            upper_bound = q3 + k * iqr   # get upper bound
+            lower_bound = q1 - k * iqr   # get lower bound
+    
+            # return dataframe without outliers
+            
+            before = len(df)
+            df = df[(df[f'{col}'] > lower_bound) & (df[f'{col}'] < upper_bound)]
+            counts[col] = before - len(df)
+    
+    else:
+        raise ValueError(f"method must be 'sequential' or 'vectorized', got {method}")
+    
+    if return_counts:
+        return df, counts.rename('rows_dropped')
+    
     return df
 
 
 #########################
 
-def drop_zillow_outliers(df):
+def zillow_outliers_mask(df):
     '''
+    Returns a boolean series, True for the rows drop_zillow_outliers keeps
+    (1-6 bathrooms, 1-7 bedrooms, tax rate under 15)
     '''
-    
-    return df[((df.bathroomcnt <= 6) & (df.bathroomcnt > 0) & 
+    return ((df.bathroomcnt <= 6) & (df.bathroomcnt > 0) & 
         (df.bedroomcnt <= 7) & (df.bedroomcnt > 0) & 
-        (df.tax_rate < 15))]
+        (df.tax_rate < 15))
 
 #########################
 
-def drop_unneeded_cols(df, unneeded_cols = ['lotsizesquarefeet', 'regionidcity', 'regionidcounty', 'assessmentyear']):
+def drop_zillow_outliers(df):
+    '''
+    Drops rows with too many / zero bathrooms or bedrooms and crazy tax rates (see zillow_outliers_mask)
+    '''
+    
+    return df[zillow_outliers_mask(df)]
+
+#########################
+
+def drop_unneeded_cols(df, unneeded_cols = ['lotsizesquarefeet', 'regionidcity', 'regionidcounty', 'assessmentyear']):
     '''
     This function takes in a dataframe and a list of unneeded columns (default is for zillow data)
     Returns dataframe with those columns dropped
@@ -330,11 +1053,15 @@ def drop_rows_low_percent(df):
     Drops all rows with missing values in those rows.
     '''
     
-    has_percent_below_one = ((df.isnull().sum() / df.shape[0]) < .01)
+    mask = null_mask(df)
+    
+    has_percent_below_one = ((mask.col_null_counts() / df.shape[0]) < .01)
     
     one_percenters = list(has_percent_below_one[has_percent_below_one == True].index)
     
-    df = df.dropna(axis=0, subset=one_percenters)
+    # rows with no nulls in any of those columns
+    keep_rows = mask.select_columns(one_percenters).row_null_counts() == 0
+    df = df[keep_rows]
     
     return df
 
@@ -350,18 +1077,90 @@ def absolute_logerror(df):
 
 #########################
 
-def wrangle_zillow():
-
-    df = get_zillow_data()
-
-    df = single_homes(df)
+def compact_dtypes(df, max_category_ratio = .5, downcast_floats = False, verbose = True):
+    '''
+    Shrinks a dataframe's memory without changing any values.
+    - text columns with few unique values (unique values <= max_category_ratio * non null rows) become categoricals
+    - integer columns get the smallest int type that fits
+    - float columns that are all whole numbers and have no nulls become the smallest int type that fits
+    - optional downcast_floats: float columns that can be stored as float32 without losing anything become float32
+      (off by default, math on two float32 columns comes out float32 and can change later results a little)
+    Prints out how many bytes were saved if verbose.
+    Returns the compacted dataframe
+    '''
+    before = df.memory_usage(deep=True).sum()
+    
+    # new versions of the columns that changed
+    compacted = {}
+    
+    for col in df.columns:
+        
+        s = df[col]
+        
+        # text -> category if not too many unique values
+        if pd.api.types.is_object_dtype(s) or isinstance(s.dtype, pd.StringDtype):
+            if s.nunique() <= max_category_ratio * s.notna().sum():
+                compacted[col] = s.astype('category')
+        
+        # ints -> smallest int
+        elif pd.api.types.is_integer_dtype(s):
+            compacted[col] = pd.to_numeric(s, downcast='integer')
+        
+        # whole number floats with no nulls -> smallest int
+        elif pd.api.types.is_float_dtype(s):
+            if s.notna().all() and (s % 1 == 0).all():
+                compacted[col] = pd.to_numeric(s, downcast='integer')
+            
+            elif downcast_floats:
+                as_32 = s.astype('float32')
+                
+                # only keep float32 if every value comes back exactly the same
+                if ((as_32 == s) | s.isnull()).all():
+                    compacted[col] = as_32
+    
+    df = df.assign(**compacted)
+    
+    if verbose:
+        after = df.memory_usage(deep=True).sum()
+        print(f'Compacted {len(compacted)} columns: {before:,} bytes -> {after:,} bytes ({before - after:,} bytes saved)')
+    
+    return df
 
-    df = drop_missing(df)
+#########################
 
+def wrangle_zillow_fused(df, min_col_percent = .65, min_row_percent = .85, 
+                         unneeded_cols = ['lotsizesquarefeet', 'regionidcity', 'regionidcounty', 'assessmentyear']):
+    '''
+    Same steps and same result as wrangle_zillow, but rows are only dropped once at the very end.
+    Each row filter (single_homes, drop_missing, drop_zillow_outliers, drop_rows_low_percent) becomes a boolean mask 
+    and the masks get combined, instead of making a new filtered dataframe at every step.
+    Steps that depend on what's left after earlier filters (drop_missing thresholds, yearbuilt bin edges, 
+    the under 1 percent null columns) are worked out on just the rows that are still kept at that point.
+    The dataframe passed in is not changed.
+    '''
+    # shallow copy, so adding columns doesn't touch the caller's dataframe
+    df = df.copy(deep=False)
+    
+    # single_homes
+    keep = single_homes_mask(df).to_numpy(copy=True)
+    
+    # drop_missing, columns first: counts of non nulls only over the rows still kept
+    mask = null_mask(df)
+    col_thresh = int(round(min_col_percent * keep.sum()))
+    col_kept = (keep.sum() - mask.take_rows(keep).col_null_counts()).to_numpy() >= col_thresh
+    
+    # then rows: enough non nulls in the columns that are left
+    row_thresh = int(round(min_row_percent * col_kept.sum()))
+    keep &= (col_kept.sum() - mask.select_columns(col_kept).row_null_counts()) >= row_thresh
+    
+    kept_cols = list(df.columns[col_kept])
+    
+    # new columns are row by row math, fine to do on every row
     df = get_house_age(df)
-
-    df = yearbuilt_bins(df)
-
+    
+    # bin edges come from the kept rows only
+    df = yearbuilt_bins(df, yearbuilt_edges(df['yearbuilt'][keep]))
+    
     df = get_tax_rate(df)
 
     df = ppsqft(df)
@@ -369,21 +1168,503 @@ def wrangle_zillow():
     df = cali_counties(df)
 
     df = absolute_logerror(df)
+    
+    # drop_zillow_outliers
+    keep &= zillow_outliers_mask(df).to_numpy()
+    
+    # drop_unneeded_cols, keeping the same column order the step by step version ends up with
+    new_cols = ['age', 'yearbuilt_bins', 'tax_rate', 'ppsqft', 'county', 'abs_logerror']
+    final_cols = [col for col in kept_cols + new_cols if col not in unneeded_cols]
+    
+    # drop_rows_low_percent: percent null per column over the rows still kept
+    n_kept = keep.sum()
+    one_percenters = [col for col in final_cols 
+                      if np.count_nonzero(df[col].isnull().to_numpy() & keep) / n_kept < .01]
+    
+    for col in one_percenters:
+        keep &= df[col].notna().to_numpy()
+    
+    # the one and only filtered copy
+    return df.loc[keep, final_cols]
 
-    df = drop_zillow_outliers(df)
+#########################
 
-    #df = remove_outliers(df, 3, col_list = ['calculatedfinishedsquarefeet', 'taxamount'])
+def zillow_stages(compact = True, fused = False, min_col_percent = .65, min_row_percent = .85):
+    '''
+    Returns the steps of wrangle_zillow in order as a list of (name, function, params) tuples.
+    Each function takes the output of the step before it plus its params. Used by run_stages.
+    compact = start with compact_dtypes
+    fused = use wrangle_zillow_fused as one step instead of the separate steps
+    min_col_percent, min_row_percent = passed to drop_missing
+    '''
+    stages = []
+    
+    if compact:
+        stages.append(('compact_dtypes', compact_dtypes, {}))
+    
+    if fused:
+        stages.append(('wrangle_zillow_fused', wrangle_zillow_fused, 
+                       {'min_col_percent': min_col_percent, 'min_row_percent': min_row_percent}))
+        return stages
+    
+    stages += [('single_homes', single_homes, {}),
+               ('drop_missing', drop_missing, {'min_col_percent': min_col_percent, 'min_row_percent': min_row_percent}),
+               ('get_house_age', get_house_age, {}),
+               ('yearbuilt_bins', yearbuilt_bins, {}),
+               ('get_tax_rate', get_tax_rate, {}),
+               ('ppsqft', ppsqft, {}),
+               ('cali_counties', cali_counties, {}),
+               ('absolute_logerror', absolute_logerror, {}),
+               ('drop_zillow_outliers', drop_zillow_outliers, {}),
+               #('remove_outliers', remove_outliers, {'k': 3, 'col_list': ['calculatedfinishedsquarefeet', 'taxamount']}),
+               ('drop_unneeded_cols', drop_unneeded_cols, {}),
+               ('drop_rows_low_percent', drop_rows_low_percent, {})]
+    
+    return stages
 
-    df = drop_unneeded_cols(df)
+#########################
 
-    df = drop_rows_low_percent(df)
+def _project_object(obj):
+    '''
+    True if obj (function, class or module) comes from a .py file in this project's folder
+    '''
+    try:
+        source_file = inspect.getsourcefile(obj) if not inspect.ismodule(obj) else obj.__file__
+    except TypeError:
+        return False
+    
+    return source_file is not None and os.path.dirname(os.path.abspath(source_file)) == os.path.dirname(os.path.abspath(__file__))
 
-    return df
+#########################
+
+def stage_helpers(func):
+    '''
+    Returns func plus every function and class from this project it calls, 
+    followed all the way down (i.e. split_stage -> banana_split -> split_indices). 
+    Helpers called through a module (cluster.make_clusters) count too.
+    '''
+    found = {}
+    todo = [func]
+    
+    while todo:
+        obj = todo.pop()
+        
+        if id(obj) in found:
+            continue
+        found[id(obj)] = obj
+        
+        # code objects to look through: the function's own (plus nested ones), or every method of a class
+        if inspect.isclass(obj):
+            # classmethods / staticmethods keep the function in __func__
+            methods = [getattr(member, '__func__', member) for member in vars(obj).values()]
+            codes = [method.__code__ for method in methods if inspect.isfunction(method)]
+            scope = vars(inspect.getmodule(obj))
+        elif inspect.isfunction(obj):
+            codes = [obj.__code__]
+            scope = obj.__globals__
+        else:
+            continue
+        
+        names = set()
+        while codes:
+            code = codes.pop()
+            names.update(code.co_names)
+            codes += [const for const in code.co_consts if inspect.iscode(const)]
+        
+        # names can be globals, or attributes of one of this project's modules
+        scopes = [scope] + [vars(scope[name]) for name in names 
+                            if inspect.ismodule(scope.get(name)) and _project_object(scope[name])]
+        
+        for name in names:
+            for names_scope in scopes:
+                helper = names_scope.get(name)
+                if (inspect.isfunction(helper) or inspect.isclass(helper)) and _project_object(helper):
+                    todo.append(helper)
+    
+    return list(found.values())
+
+#########################
+
+def stage_source(func):
+    '''
+    Source code of a stage function and of every helper it calls (see stage_helpers), falls back to its name.
+    Editing a stage or anything it uses changes its checkpoint key
+    '''
+    sources = []
+    
+    for helper in stage_helpers(func):
+        try:
+            sources.append(inspect.getsource(helper))
+        except (OSError, TypeError):
+            sources.append(getattr(helper, '__qualname__', repr(helper)))
+    
+    # same order every time, whatever order the helpers were found in
+    return '\n'.join(sorted(sources))
+
+#########################
+
+def run_stages(data, stages, checkpoint_dir = None):
+    '''
+    Runs data through a list of (name, function, params) stages in order and returns the output of the last one.
+    checkpoint_dir = optional folder for on disk checkpoints. Each stage's output is saved there,
+    keyed by a hash of its input's key, the stage name, its source code (and the helpers it calls) and its params 
+    (the first input's key is a hash of the data itself).
+    On the next run everything up to the last stage with a matching checkpoint gets skipped,
+    so changing one stage's params only reruns from that stage on.
+    Checkpoints use the same eviction and hit / miss stats as the rest of the cache module.
+    '''
+    if checkpoint_dir is None:
+        for name, func, params in stages:
+            data = func(data, **params)
+        return data
+    
+    # chain the keys, every key depends on everything before it
+    key = cache.hash_frame(data)
+    paths = []
+    
+    for name, func, params in stages:
+        key = cache.hash_key(key, name, stage_source(func), sorted(params.items()))
+        paths.append(cache.cache_path(key, 'pkl', checkpoint_dir))
+    
+    # find the last stage that already has a checkpoint and pick up from there
+    start = 0
+    for i in reversed(range(len(stages))):
+        if cache.lookup(paths[i]):
+            data = pd.read_pickle(paths[i])
+            start = i + 1
+            print(f'Loaded checkpoint for {stages[i][0]}')
+            break
+    
+    # run and save everything after it
+    for (name, func, params), path in zip(stages[start:], paths[start:]):
+        data = func(data, **params)
+        pd.to_pickle(data, path)
+    
+    cache.evict(checkpoint_dir, keep=paths)
+    
+    return data
+
+#########################
+
+def wrangle_zillow(compact = True, fused = False, df = None, checkpoint_dir = None):
+    '''
+    First part of the wrangle. Gets the Zillow data and runs it through all the prep steps (see zillow_stages).
+    compact = if True (default) shrinks the dtypes right after acquiring (see compact_dtypes), values stay the same
+    fused = if True, the row filters are combined and applied once (see wrangle_zillow_fused), same result, less copying
+    df = optional raw Zillow dataframe to use instead of calling get_zillow_data
+    checkpoint_dir = optional folder to save each step's output in, see run_stages
+    returns the wrangled dataframe
+    '''
+    if df is None:
+        df = get_zillow_data()
+    
+    return run_stages(df, zillow_stages(compact, fused), checkpoint_dir)
+
+#########################
+
+def benchmark_wrangle_zillow(df = None, repeat = 3):
+    '''
+    Compares wrangle_zillow step by step (staged) against the fused version on the same raw data.
+    Wall time is the best of repeat runs, peak memory comes from a separate run with tracemalloc on
+    (tracemalloc slows things down, so it isn't on while timing).
+    df = raw Zillow dataframe, default calls get_zillow_data
+    Prints whether both versions give the same result.
+    Returns a dataframe with seconds, peak_mb and rows for each mode.
+    '''
+    if df is None:
+        df = get_zillow_data()
+    
+    results = {}
+    outputs = {}
+    
+    for mode, fused in [('staged', False), ('fused', True)]:
+        
+        # wall time
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[mode] = wrangle_zillow(compact = False, fused = fused, df = df)
+            times.append(time.perf_counter() - start)
+        
+        # peak memory allocated while running
+        tracemalloc.start()
+        wrangle_zillow(compact = False, fused = fused, df = df)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        results[mode] = {'seconds': min(times), 'peak_mb': peak / 1024**2, 'rows': len(outputs[mode])}
+    
+    print(f"Same result: {outputs['staged'].equals(outputs['fused'])}")
+    
+    return pd.DataFrame(results).T
+
+######################### Out of core wrangle #########################
+
+def iter_cache_chunks(path, chunksize = 50_000):
+    '''
+    Generator of dataframes from a cache file, chunksize rows at a time, 
+    without reading the whole file. parquet (one batch at a time) or csv.
+    '''
+    if path.endswith('.parquet'):
+        
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield pa.Table.from_batches([batch]).to_pandas()
+    else:
+        yield from pd.read_csv(path, index_col=0, chunksize=chunksize)
+
+#########################
+
+def _common_dtype(a, b):
+    '''
+    dtype that can hold both a and b (int + float -> float, anything + text -> object)
+    '''
+    if a is None:
+        return b
+    
+    if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+        return np.result_type(a, b)
+    
+    return a if a == b else np.dtype(object)
+
+#########################
+
+def read_partitioned(out_dir):
+    '''
+    Reads the partitioned output of wrangle_zillow_out_of_core back into one dataframe,
+    with yearbuilt_bins turned back into the same categorical pd.cut makes
+    '''
+    with open(os.path.join(out_dir, '_meta.json')) as f:
+        meta = json.load(f)
+    
+    # only the parts this run wrote, never anything else that ended up in the folder
+    df = pd.concat([pd.read_parquet(os.path.join(out_dir, part)) for part in meta['parts']])
+    
+    # parquet can change some dtypes (i.e. text columns), put them back
+    df = df.astype(meta['dtypes'])
+    
+    # yearbuilt_bins is stored as bin numbers (-1 is null), same bins as pd.cut makes
+    bins = pd.IntervalIndex.from_breaks(np.asarray(meta['year_bins'], dtype=float))
+    df['yearbuilt_bins'] = pd.Categorical.from_codes(df['yearbuilt_bins'], bins, ordered=True)
+    
+    return df[meta['columns']]
+
+#########################
+
+def wrangle_zillow_out_of_core(chunks, out_dir = 'zillow_wrangled', min_col_percent = .65, min_row_percent = .85,
+                               unneeded_cols = ['lotsizesquarefeet', 'regionidcity', 'regionidcounty', 'assessmentyear']):
+    '''
+    Same steps as wrangle_zillow (without compact_dtypes), for data that doesn't fit in memory.
+    chunks = a function that returns a new iterable of raw Zillow dataframes every time it is called 
+             (the data gets read more than once), i.e.
+             lambda: stream_any_data('zillow', ZILLOW_SQL.format(delta_filter=''))
+             lambda: iter_cache_chunks(zillow_cache_path())
+    out_dir = folder the result is written to, one parquet file per chunk plus _meta.json.
+              Read it back with read_partitioned. Everything gets written to a fresh out_dir.tmp folder first
+              and swapped in at the end, so old parts from an earlier run never get mixed in.
+    Three passes, only one chunk in memory at a time:
+    1. over the raw chunks: dtypes, row count and non null counts per column after single_homes (for drop_missing)
+    2. over the raw chunks again: the row by row steps, drop_missing with the thresholds from pass 1, 
+       drop_zillow_outliers and drop_unneeded_cols. Finds yearbuilt min / max (for yearbuilt_bins) and 
+       the null counts drop_rows_low_percent needs, writes the chunks to a staging folder
+    3. over the (smaller) staged chunks: adds yearbuilt_bins, drops rows for the under 1 percent null columns, writes out_dir
+    Returns the number of rows written.
+    Raises ValueError if chunks() gives no chunks at all. If every row gets filtered out, 
+    out_dir still gets one empty part with the right columns, so read_partitioned gives back an empty dataframe.
+    '''
+    # fresh folder for this run, swapped in for out_dir at the end
+    out_dir = os.path.normpath(out_dir)
+    tmp_dir = f'{out_dir}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    staging_dir = os.path.join(tmp_dir, '_staging')
+    os.makedirs(staging_dir)
+    
+    ##### pass 1: drop_missing stats #####
+    dtypes = {}
+    n_rows = 0
+    notnull_counts = None
+    
+    for chunk in chunks():
+        
+        # widest dtype seen per column, ignoring chunks where a column is all null 
+        # (same dtypes the whole table would get if it was read in one go)
+        for col in chunk.columns:
+            if chunk[col].notna().any():
+                dtypes[col] = _common_dtype(dtypes.get(col), chunk[col].dtype)
+        
+        chunk = single_homes(chunk)
+        
+        n_rows += len(chunk)
+        counts = chunk.notna().sum()
+        notnull_counts = counts if notnull_counts is None else notnull_counts + counts
+    
+    if notnull_counts is None:
+        raise ValueError('chunks() gave no chunks, nothing to wrangle')
+    
+    # same thresholds drop_missing would use on the whole table
+    col_thresh = int(round(min_col_percent * n_rows))
+    kept_cols = list(notnull_counts.index[notnull_counts >= col_thresh])
+    row_thresh = int(round(min_row_percent * len(kept_cols)))
+    
+    ##### pass 2: row by row steps, yearbuilt edges and null counts #####
+    year_min, year_max = np.inf, -np.inf
+    year_counts = pd.Series(dtype=float)
+    null_counts = None
+    n_final = 0
+    staged = []
+    # dtypes are merged over the chunks that have rows, an empty chunk's dtypes can be wrong 
+    # (i.e. county comes out float64 from fips.replace on no rows)
+    out_dtypes = {}
+    
+    for chunk in chunks():
+        
+        chunk = chunk.astype({col: dtype for col, dtype in dtypes.items() if chunk[col].dtype != dtype})
+        
+        chunk = single_homes(chunk)
+        
+        # drop_missing with the whole table's thresholds
+        chunk = chunk[kept_cols].dropna(axis=0, thresh=row_thresh)
+        
+        # yearbuilt_bins edges come from here (after drop_missing, before the outliers go)
+        year_min = min(year_min, chunk['yearbuilt'].min())
+        year_max = max(year_max, chunk['yearbuilt'].max())
+        
+        chunk = get_house_age(chunk)
+        
+        chunk = get_tax_rate(chunk)
+        
+        chunk = ppsqft(chunk)
+        
+        chunk = cali_counties(chunk)
+        
+        chunk = absolute_logerror(chunk)
+        
+        chunk = drop_zillow_outliers(chunk)
+        
+        chunk = drop_unneeded_cols(chunk, unneeded_cols)
+        
+        # for drop_rows_low_percent: nulls per column, and how many of each yearbuilt 
+        # (the oldest year ends up null in yearbuilt_bins, pd.cut leaves out the lowest edge)
+        n_final += len(chunk)
+        counts = chunk.isnull().sum()
+        null_counts = counts if null_counts is None else null_counts + counts
+        year_counts = year_counts.add(chunk['yearbuilt'].value_counts(), fill_value=0)
+        
+        # the columns are the same for every chunk, empty or not
+        columns = list(chunk.columns)
+        
+        # nothing left in this chunk, nothing to stage
+        if chunk.empty:
+            continue
+        
+        # dtypes before parquet, so they can be put back exactly when reading
+        for col, dtype in chunk.dtypes.items():
+            if chunk[col].notna().any() or col not in out_dtypes:
+                out_dtypes[col] = _common_dtype(out_dtypes.get(col), dtype)
+        
+        part_path = os.path.join(staging_dir, f'part-{len(staged):05d}.parquet')
+        chunk.to_parquet(part_path, index=True)
+        staged.append(part_path)
+    
+    # no rows left after drop_missing anywhere, edges just need to be in order
+    if year_min > year_max:
+        year_min, year_max = 1978, 2000
+    
+    year_bins = [year_min, 1978, 2000, year_max]
+    
+    # yearbuilt_bins goes right after age, same as wrangle_zillow
+    columns.insert(columns.index('age') + 1, 'yearbuilt_bins')
+    
+    null_counts['yearbuilt_bins'] = null_counts['yearbuilt'] + year_counts.get(year_min, 0)
+    one_percenters = [col for col in columns if n_final and null_counts[col] / n_final < .01]
+    
+    ##### pass 3: yearbuilt_bins and drop_rows_low_percent #####
+    rows = 0
+    parts = []
+    
+    for i, part_path in enumerate(staged):
+        
+        chunk = pd.read_parquet(part_path)
+        
+        chunk = yearbuilt_bins(chunk, year_bins)[columns]
+        
+        chunk = chunk.dropna(axis=0, subset=one_percenters)
+        
+        # parquet can't store interval categoricals, store the bin number instead
+        chunk['yearbuilt_bins'] = chunk['yearbuilt_bins'].cat.codes
+        
+        parts.append(f'part-{i:05d}.parquet')
+        chunk.to_parquet(os.path.join(tmp_dir, parts[-1]), index=True)
+        rows += len(chunk)
+    
+    # every row got filtered out: one empty part so there is still something to read back
+    if not staged:
+        empty = pd.DataFrame({col: pd.Series(dtype=out_dtypes.get(col, 'float64')) for col in columns})
+        empty['yearbuilt_bins'] = empty['yearbuilt_bins'].astype(np.int8)
+        parts.append('part-00000.parquet')
+        empty.to_parquet(os.path.join(tmp_dir, parts[-1]), index=True)
+    
+    shutil.rmtree(staging_dir)
+    
+    out_dtypes = {col: str(dtype) for col, dtype in out_dtypes.items()}
+    
+    with open(os.path.join(tmp_dir, '_meta.json'), 'w') as f:
+        json.dump({'columns': columns, 'dtypes': out_dtypes, 'rows': rows, 'parts': parts,
+                   'year_bins': [float(edge) for edge in year_bins]}, f)
+    
+    # swap the new folder in, the old one (if any) is only deleted once the new one is in place
+    old_dir = f'{out_dir}.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    
+    return rows
+
+
+def scale_block(train, validate, test, col_names, scaler, float32 = False):
+    '''
+    Fits the scaler once on all of train[col_names] and transforms validate and test in one call each.
+    Returns the scaled train, validate and test as 2d arrays (columns in col_names order) 
+    float32 = return float32 arrays instead of float64 (half the memory)
+    '''
+    train_scaled = scaler.fit_transform(train[col_names])
+    validate_scaled = scaler.transform(validate[col_names])
+    test_scaled = scaler.transform(test[col_names])
+    
+    dtype = np.float32 if float32 else np.float64
+    
+    return train_scaled.astype(dtype, copy=False), validate_scaled.astype(dtype, copy=False), test_scaled.astype(dtype, copy=False)
 
 #########################
 
+def inverse_scale(scaler, df, col_names, cols = None):
+    '''
+    Undoes scaling done with a batched my_scaler / my_scaler2 (a scaler fit on all of col_names at once).
+    scaler = the fitted scaler
+    df = dataframe with the scaled values, in columns named cols
+    col_names = every column the scaler was fit on, in the same order
+    cols = which of those columns to unscale (default all of them), any subset works
+    Works for scalers that treat each column on its own (MinMaxScaler, StandardScaler, RobustScaler...)
+    Returns a dataframe of the unscaled columns
+    '''
+    cols = list(col_names) if cols is None else list(cols)
+    positions = [list(col_names).index(col) for col in cols]
+    
+    # put the scaled values where the scaler expects them, the other columns don't matter
+    full = np.zeros((len(df), len(col_names)))
+    full[:, positions] = df[cols].to_numpy()
+    
+    unscaled = scaler.inverse_transform(full)[:, positions]
+    
+    return pd.DataFrame(unscaled, columns = cols, index = df.index)
+
+#########################
 
-def my_scaler(train, validate, test, col_names, scaler, scaler_name):
+def my_scaler(train, validate, test, col_names, scaler, scaler_name, batched = False, float32 = False):
     
     '''
     This function takes in the train validate and test dataframes, columns you want to scale (as a list), a scaler (i.e. MinMaxScaler(), with whatever paramaters you need),
@@ -395,6 +1676,10 @@ def my_scaler(train, validate, test, col_names, scaler, scaler_name):
     Ouputs a list of the new column names (what you can use to create the X_train).
     
     example: min_max_scaler, scaled_cols_list = my_scaler(train, validate, test, MinMaxScaler(), 'scaled_min_max')
+    batched = if True the scaler is fit once on all the columns together (see scale_block), 
+    so the returned scaler can undo any or all of them with inverse_scale.
+    Default False fits one column at a time, the returned scaler only knows the last column.
+    float32 = if True (batched only) the new columns are float32
     
     '''
     
@@ -404,20 +1689,33 @@ def my_scaler(train, validate, test, col_names, scaler, scaler_name):
     # make empty list for return
     scaled_cols_list = []
     
-    # loop through columns in col names
-    for col in col_names:
-        
-        #fit and transform to train, add to new column on train df
-        train[f'{col}_{scaler_name}'] = mm_scaler.fit_transform(train[[col]]) 
+    if batched:
         
-        #df['col'].values.reshape(-1, 1)
+        scaled_cols_list = [f'{col}_{scaler_name}' for col in col_names]
         
-        #transform cols from validate and test (only fit on train)
-        validate[f'{col}_{scaler_name}']= mm_scaler.transform(validate[[col]])
-        test[f'{col}_{scaler_name}']= mm_scaler.transform(test[[col]])
+        # one fit, one transform each for validate and test
+        train_scaled, validate_scaled, test_scaled = scale_block(train, validate, test, col_names, mm_scaler, float32)
         
-        #add new column name to the list that will get returned
-        scaled_cols_list.append(f'{col}_{scaler_name}')
+        for i, new_col in enumerate(scaled_cols_list):
+            train[new_col] = train_scaled[:, i]
+            validate[new_col] = validate_scaled[:, i]
+            test[new_col] = test_scaled[:, i]
+    
+    else:
+        # loop through columns in col names
+        for col in col_names:
+            
+            #fit and transform to train, add to new column on train df
+            train[f'{col}_{scaler_name}'] = mm_scaler.fit_transform(train[[col]]) 
+            
+            #df['col'].values.reshape(-1, 1)
+            
+            #transform cols from validate and test (only fit on train)
+            validate[f'{col}_{scaler_name}']= mm_scaler.transform(validate[[col]])
+            test[f'{col}_{scaler_name}']= mm_scaler.transform(test[[col]])
+            
+            #add new column name to the list that will get returned
+            scaled_cols_list.append(f'{col}_{scaler_name}')
     
     #confirmation print
     print('Your scaled columns have been added to your train validate and test dataframes.')
@@ -429,21 +1727,122 @@ def my_scaler(train, validate, test, col_names, scaler, scaler_name):
 ######################### the train validate test splitter 
 
 
-def banana_split(df):
+def split_indices(n_rows, test_size = .2, validate_size = .3, random_state = 713, stratify = None):
+    '''
+    Works out a train validate test split as row positions, no data gets copied.
+    test_size = share of all rows for test, validate_size = share of what's left for validate (same as banana_split)
+    stratify = optional array of labels (one per row) to keep the same mix in each split
+    Returns train, validate, test position arrays (same rows, same order, as train_test_split on a dataframe)
+    '''
+    positions = np.arange(n_rows)
+    stratify = None if stratify is None else np.asarray(stratify)
+    
+    train_validate, test = train_test_split(positions, test_size=test_size, random_state=random_state, stratify=stratify)
+    
+    train, validate = train_test_split(train_validate, test_size=validate_size, random_state=random_state,
+                                       stratify=None if stratify is None else stratify[train_validate])
+    
+    return train, validate, test
+
+#########################
+
+def kfold_indices(n_rows, n_splits = 5, random_state = 713, stratify = None):
+    '''
+    K-fold version of split_indices: returns a list of n_splits (train, validate) position arrays,
+    shuffled, every row is in exactly one validate.
+    stratify = optional array of labels to keep the same mix in every fold
+    '''
+    if stratify is None:
+        folds = KFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(np.zeros(n_rows))
+    else:
+        folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(np.zeros(n_rows), stratify)
+    
+    return list(folds)
+
+#########################
+
+class LazySplit:
+    '''
+    Holds a dataframe and the row positions of each split, and only makes the split dataframes when they're used.
+    split.train (or split['train']) makes it the first time and hands back the same one after that,
+    split.indices has the positions, and train, validate, test = split works like banana_split.
+    '''
+    def __init__(self, df, indices):
+        self.df = df
+        # name -> position array, in order
+        self.indices = indices
+        self._frames = {}
+    
+    def __getitem__(self, name):
+        if name not in self._frames:
+            self._frames[name] = self.df.iloc[self.indices[name]]
+        return self._frames[name]
+    
+    def __getattr__(self, name):
+        if name in ('df', 'indices', '_frames'):
+            raise AttributeError(name)
+        if name in self.indices:
+            return self[name]
+        raise AttributeError(name)
+    
+    def __iter__(self):
+        return (self[name] for name in self.indices)
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def shapes(self):
+        '''
+        Dictionary of name -> (rows, columns) for each split, without making them
+        '''
+        return {name: (len(positions), self.df.shape[1]) for name, positions in self.indices.items()}
+
+#########################
+
+def _split_labels(df, stratify):
+    '''
+    stratify can be a column name or an array, returns the array (or None)
+    '''
+    if isinstance(stratify, str):
+        return df[stratify].to_numpy()
+    
+    return stratify
+
+#########################
+
+def banana_split(df, lazy = False, stratify = None):
     '''
     args: df
     This function take in the telco_churn data data acquired by aquire.py, get_telco_data(),
     performs a split.
     Returns train, validate, and test dfs.
+    The split is worked out on row positions first (split_indices), so there is no in between train_validate copy.
+    lazy = if True returns a LazySplit instead, the dataframes only get made when they are used
+    stratify = optional column name (or array) to stratify on
     '''
-    train_validate, test = train_test_split(df, test_size=.2, 
-                                        random_state=713)
-    train, validate = train_test_split(train_validate, test_size=.3, 
-                                   random_state=713)
-    print(f'train --> {train.shape}')
-    print(f'validate --> {validate.shape}')
-    print(f'test --> {test.shape}')
-    return train, validate, test
+    train, validate, test = split_indices(len(df), stratify=_split_labels(df, stratify))
+    
+    split = LazySplit(df, {'train': train, 'validate': validate, 'test': test})
+    
+    for name, shape in split.shapes().items():
+        print(f'{name} --> {shape}')
+    
+    if lazy:
+        return split
+    
+    return tuple(split)
+
+#########################
+
+def banana_folds(df, n_splits = 5, stratify = None):
+    '''
+    K-fold splits of df for cross validation. Returns a list of n_splits LazySplits with train and validate,
+    each fold's dataframes only get made when they are used (one fold at a time, not k copies up front)
+    stratify = optional column name (or array) to stratify on
+    '''
+    folds = kfold_indices(len(df), n_splits, stratify=_split_labels(df, stratify))
+    
+    return [LazySplit(df, {'train': train, 'validate': validate}) for train, validate in folds]
 
 
 ######################### an X_df and y_df splitter
@@ -471,29 +1870,173 @@ def all_aboard_the_X_train(X_cols, y_col, train, validate, test):
 
 #########################
 
-def get_zillow_dummies(train, validate, test, cat_vars = ['yearbuilt_bins', 'county', 'clusters_locationprice']):
+def middle_category(categories):
     '''
-    Function takes in train, validate and test and a list of columns to be turned into dummies (cat_vars)
-    default col_list is for zillow 
+    Returns the middle category (for drop in DummyEncoder), i.e. the 1978-2000 bin of yearbuilt_bins
     '''
-    # create dummies 
-    train = pd.get_dummies(data = train, columns = cat_vars, drop_first=False)
-    validate = pd.get_dummies(data = validate, columns = cat_vars, drop_first=False)
-    test = pd.get_dummies(data = test, columns = cat_vars, drop_first=False)
+    return categories[len(categories) // 2]
 
+# the dummies to drop, and better names for the age bins (by position, so they hold up if the bin edges change)
+ZILLOW_DUMMY_DROP = {'yearbuilt_bins': middle_category, 'county': 'Ventura', 'clusters_locationprice': 0}
+ZILLOW_DUMMY_NAMES = {'yearbuilt_bins': ['built_before_1978', 'built_1978_2000', 'built_after_2000']}
 
-    # drop columns I don't want (specified above)
-    train = train.drop(columns=['yearbuilt_bins_(1978.0, 2000.0]', 'county_Ventura', 'clusters_locationprice_0'])
-    validate = validate.drop(columns=['yearbuilt_bins_(1978.0, 2000.0]', 'county_Ventura', 'clusters_locationprice_0'])
-    test = test.drop(columns=['yearbuilt_bins_(1978.0, 2000.0]', 'county_Ventura', 'clusters_locationprice_0'])
+#########################
+
+class DummyEncoder:
+    '''
+    One hot encoder that learns its columns once, from train, so train, validate and test 
+    (and anything later on) always come out with exactly the same dummy columns in the same order.
+    cat_vars = columns to turn into dummies
+    drop = {column: category to leave out, or a function that picks it from the list of categories}
+    names = {column: list of dummy names, in category order} instead of the usual {column}_{category}
+    handle_unknown = 'ignore' (default) gives a row all zeros for a category train never had, 'error' raises
+    fit(train), then transform(df) for dataframes (sparse = True for sparse columns) 
+    or sparse_matrix(df) for a scipy csr matrix of only the dummies.
+    get_state / from_state turn it into plain lists and strings and back, for saving.
+    '''
+    def __init__(self, cat_vars, drop = None, names = None, handle_unknown = 'ignore'):
+        if handle_unknown not in ('ignore', 'error'):
+            raise ValueError(f"handle_unknown must be 'ignore' or 'error', got {handle_unknown}")
+        
+        self.cat_vars = list(cat_vars)
+        self.drop = drop or {}
+        self.names = names or {}
+        self.handle_unknown = handle_unknown
+        # matching on strings, for an encoder that came back from get_state
+        self.by_string = False
+    
+    def fit(self, train):
+        '''
+        Learns the categories of each column from train: category order for categoricals, sorted for everything else
+        (same order pd.get_dummies uses). Returns the encoder
+        '''
+        categories = {}
+        
+        for col in self.cat_vars:
+            if isinstance(train[col].dtype, pd.CategoricalDtype):
+                categories[col] = list(train[col].cat.categories)
+            else:
+                categories[col] = sorted(train[col].dropna().unique())
+        
+        return self._build(categories)
     
-    # rename age bins because they have a dumb name
-    train = train.rename(columns={'yearbuilt_bins_(1878.0, 1978.0]': 'built_before_1978', 
-                                  'yearbuilt_bins_(2000.0, 2016.0]': 'built_after_2000'})
-    validate = validate.rename(columns={'yearbuilt_bins_(1878.0, 1978.0]': 'built_before_1978', 
-                                  'yearbuilt_bins_(2000.0, 2016.0]': 'built_after_2000'})
-    test = test.rename(columns={'yearbuilt_bins_(1878.0, 1978.0]': 'built_before_1978', 
-                                  'yearbuilt_bins_(2000.0, 2016.0]': 'built_after_2000'})
+    def _build(self, categories):
+        '''
+        Works out the output columns from the categories: which get dropped and what each one is called
+        '''
+        self.categories = {col: pd.Index(cats) for col, cats in categories.items()}
+        self.columns = []
+        # for each column, where each category goes in the output (-1 = dropped)
+        self.positions = {}
+        
+        for col in self.cat_vars:
+            cats = list(categories[col])
+            
+            drop = self.drop.get(col)
+            drop = drop(cats) if callable(drop) else drop
+            
+            names = self.names.get(col)
+            names = names if names is not None and len(names) == len(cats) else [f'{col}_{cat}' for cat in cats]
+            
+            positions = np.full(len(cats), -1, dtype=np.int64)
+            for i, (cat, name) in enumerate(zip(cats, names)):
+                if drop is None or str(cat) != str(drop):
+                    positions[i] = len(self.columns)
+                    self.columns.append(name)
+            
+            self.positions[col] = positions
+        
+        return self
+    
+    def _codes(self, df):
+        '''
+        Yields (column, position of each row's category in train's categories, -1 for missing or never seen)
+        '''
+        for col in self.cat_vars:
+            values = df[col].astype(str) if self.by_string else df[col]
+            codes = self.categories[col].get_indexer(values)
+            
+            if self.handle_unknown == 'error':
+                unseen = (codes == -1) & df[col].notna().to_numpy()
+                if unseen.any():
+                    raise ValueError(f'{col} has categories that were not in train: {list(df[col][unseen].unique()[:10])}')
+            
+            yield col, codes
+    
+    def sparse_matrix(self, df):
+        '''
+        Returns a scipy csr matrix (bool) with one row per row of df and one column per name in self.columns.
+        Only one stored value per row per column encoded, so high cardinality columns stay small
+        '''
+        rows, cols = [], []
+        
+        for col, codes in self._codes(df):
+            out = np.where(codes >= 0, self.positions[col][codes], -1)
+            keep = out >= 0
+            rows.append(np.flatnonzero(keep))
+            cols.append(out[keep])
+        
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        
+        return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(df), len(self.columns)))
+    
+    def transform(self, df, sparse = False):
+        '''
+        Returns df with the cat_vars swapped for the dummy columns (on the end, in self.columns order), 
+        like pd.get_dummies. sparse = True makes the dummies sparse bool columns
+        '''
+        matrix = self.sparse_matrix(df)
+        
+        if sparse:
+            dummies = pd.DataFrame.sparse.from_spmatrix(matrix, index=df.index, columns=self.columns)
+        else:
+            dummies = pd.DataFrame(matrix.toarray(), index=df.index, columns=self.columns)
+        
+        return pd.concat([df.drop(columns=self.cat_vars), dummies], axis=1)
+    
+    def get_state(self):
+        '''
+        The fitted encoder as a json friendly dictionary (categories as strings)
+        '''
+        return {'cat_vars': self.cat_vars, 'handle_unknown': self.handle_unknown, 'columns': self.columns,
+                'categories': {col: [str(cat) for cat in cats] for col, cats in self.categories.items()},
+                'positions': {col: positions.tolist() for col, positions in self.positions.items()}}
+    
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Rebuilds a fitted encoder from get_state, it matches categories by their string (i.e. '(1878.0, 1978.0]')
+        '''
+        encoder = cls(state['cat_vars'], handle_unknown = state['handle_unknown'])
+        encoder.by_string = True
+        encoder.categories = {col: pd.Index(cats) for col, cats in state['categories'].items()}
+        encoder.positions = {col: np.array(positions, dtype=np.int64) for col, positions in state['positions'].items()}
+        encoder.columns = list(state['columns'])
+        
+        return encoder
+
+#########################
+
+def get_zillow_dummies(train, validate, test, cat_vars = ['yearbuilt_bins', 'county', 'clusters_locationprice'], 
+                       sparse = False, return_encoder = False):
+    '''
+    Function takes in train, validate and test and a list of columns to be turned into dummies (cat_vars)
+    default col_list is for zillow 
+    The dummy columns are learned from train only (DummyEncoder), so all three always get the same columns
+    in the same order, and a category validate or test has that train didn't just gets all zeros.
+    Drops the middle yearbuilt bin, Ventura and cluster 0, and names the other age bins built_before_1978 and built_after_2000
+    sparse = True for sparse dummy columns
+    return_encoder = True to also get the fitted encoder back (for new data later)
+    '''
+    # learn the dummies from train, then make them for all three
+    encoder = DummyEncoder(cat_vars, drop = ZILLOW_DUMMY_DROP, names = ZILLOW_DUMMY_NAMES).fit(train)
+    
+    train = encoder.transform(train, sparse)
+    validate = encoder.transform(validate, sparse)
+    test = encoder.transform(test, sparse)
+    
+    if return_encoder:
+        return train, validate, test, encoder
     
     return train, validate, test
 
@@ -502,7 +2045,7 @@ def get_zillow_dummies(train, validate, test, cat_vars = ['yearbuilt_bins', 'cou
 ######################### 
 
 
-def my_scaler2(train, validate, test, col_names, scaler):
+def my_scaler2(train, validate, test, col_names, scaler, batched = False, float32 = False):
     
     '''
     This function takes in the train validate and test dataframes, columns you want to scale (as a list), 
@@ -510,23 +2053,39 @@ def my_scaler2(train, validate, test, col_names, scaler):
     col_names: list of columns to scale
     Replaces unscaled cloumns with scaled columns 
     Outputs scaler for doing inverse transforms.
+    batched = if True the scaler is fit once on all the columns together (see scale_block), 
+    so the returned scaler can undo any or all of them with inverse_scale.
+    Default False fits one column at a time, the returned scaler only knows the last column.
+    float32 = if True (batched only) the scaled columns are written back as float32, half the memory
     
     '''
     
     #create the scaler (input here should be minmax scaler)
     mm_scaler = scaler
     
-    # loop through columns in col names
-    for col in col_names:
+    if batched:
         
-        #fit and transform to train, add to new column on train df
-        train[f'{col}'] = mm_scaler.fit_transform(train[[col]]) 
+        # one fit, one transform each for validate and test
+        train_scaled, validate_scaled, test_scaled = scale_block(train, validate, test, col_names, mm_scaler, float32)
         
-        #df['col'].values.reshape(-1, 1)
-        
-        #transform cols from validate and test (only fit on train)
-        validate[f'{col}']= mm_scaler.transform(validate[[col]])
-        test[f'{col}']= mm_scaler.transform(test[[col]])
+        # replace the columns
+        for i, col in enumerate(col_names):
+            train[col] = train_scaled[:, i]
+            validate[col] = validate_scaled[:, i]
+            test[col] = test_scaled[:, i]
+    
+    else:
+        # loop through columns in col names
+        for col in col_names:
+            
+            #fit and transform to train, add to new column on train df
+            train[f'{col}'] = mm_scaler.fit_transform(train[[col]]) 
+            
+            #df['col'].values.reshape(-1, 1)
+            
+            #transform cols from validate and test (only fit on train)
+            validate[f'{col}']= mm_scaler.transform(validate[[col]])
+            test[f'{col}']= mm_scaler.transform(test[[col]])
 
     
     #returns scaler, and a list of column names that can be used in X_train, X_validate and X_test.
@@ -535,33 +2094,31 @@ def my_scaler2(train, validate, test, col_names, scaler):
 
 #########################
 
-def make_this_cluster(train, validate, test, col_list, k, col_name = None):
+def make_this_cluster(train, validate, test, col_list, k, col_name = None, backend = 'kmeans', n_threads = None, batch_size = 4096):
     '''
     Function takes in already scaled train validate and test,
     k number of clusters you want to make,
     col_list list of the columns you want to be in the cluster
     Optional argument col_name, If none is entered column returned is 'clusters'
+    Optional backend: 'kmeans' (default), 'minibatch' or 'incremental' for big data (see cluster.py)
+    Optional n_threads: limit on threads used to fit / predict, batch_size: rows per batch for the minibatch backends
+    Train clusters come straight from the fit, validate and test get predicted together in one call
     Returns dataframes with column attached, and the kmeans object
     Returns: train, validate, test, kmeans
     '''
     
-    #make thing
-    kmeans = KMeans(n_clusters=k, random_state=713)
-
-    #Fit Thing
-    kmeans.fit(train[col_list])
+    #make thing and Fit Thing
+    kmeans = cluster.fit_clusters(train[col_list], k, backend = backend, batch_size = batch_size, n_threads = n_threads)
     
+    # generic name, or the specific one (a one item list works too)
     if col_name == None:
-        # add cluster predictions on dataframe generic
-        train['clusters'] = kmeans.predict(train[col_list])
-        validate['clusters'] = kmeans.predict(validate[col_list])
-        test['clusters'] = kmeans.predict(test[col_list])
-    else:
-        # add cluster predictions on dataframe specific name
-        train[col_name] = kmeans.predict(train[col_list])
-        validate[col_name] = kmeans.predict(validate[col_list])
-        test[col_name] = kmeans.predict(test[col_list])
-        
+        col_name = 'clusters'
+    elif isinstance(col_name, list):
+        col_name = col_name[0]
+    
+    # add cluster predictions on dataframe
+    train[col_name] = cluster.train_labels(kmeans, train[col_list], backend, n_threads)
+    validate[col_name], test[col_name] = cluster.predict_clusters(kmeans, [validate, test], col_list, n_threads)
     
     return train, validate, test, kmeans
 
@@ -569,27 +2126,58 @@ def make_this_cluster(train, validate, test, col_list, k, col_name = None):
 
 ######################### WRANGLE PART 2, to use after exploring #########################
 
-def wrangle_pt2():
+def split_stage(df):
     '''
-    Second part of the wrangle function. takes in Zillow dataframe, 
-    outputs train validate and test, ready to be split into X_ and y_ dataframes
-    Does the train validate test split, makes the cluster_locationprice
-    drops uneeded columns. and creates dummy column for cat variables
-    returns train validate and test and a scaler
+    wrangle_pt2 stage: train validate test split, returns (train, validate, test)
+    '''
+    return banana_split(df)
+
+#########################
+
+def scale_stage(splits, col_names, scaler, batched = True):
+    '''
+    wrangle_pt2 stage: scales col_names with my_scaler2, returns (train, validate, test, scaler)
+    '''
+    train, validate, test = splits
+    
+    return my_scaler2(train, validate, test, col_names, scaler, batched = batched)
+
+#########################
+
+def cluster_stage(splits, col_list, k, col_name):
+    '''
+    wrangle_pt2 stage: adds the cluster column with make_this_cluster, returns (train, validate, test, scaler, kmeans)
+    '''
+    train, validate, test, scaler = splits
+    
+    train, validate, test, kmeans = make_this_cluster(train, validate, test, col_list, k, col_name = col_name)
+    
+    return train, validate, test, scaler, kmeans
+
+#########################
+
+def dummies_stage(splits, cat_vars = ['yearbuilt_bins', 'county', 'clusters_locationprice']):
+    '''
+    wrangle_pt2 stage: adds the dummy columns with get_zillow_dummies, 
+    returns (train, validate, test, scaler, kmeans, encoder)
     '''
+    train, validate, test, scaler, kmeans = splits
+    
+    train, validate, test, encoder = get_zillow_dummies(train, validate, test, cat_vars, return_encoder = True)
+    
+    return train, validate, test, scaler, kmeans, encoder
 
+#########################
+
+def pt2_stages(k = 8):
+    '''
+    Returns the steps of wrangle_pt2 (everything after wrangle_zillow) as (name, function, params) tuples.
+    k = number of clusters for clusters_locationprice
+    '''
     # define uneeded cols (maybe move this to the first part of wrangle)
     unneeded_cols = ['parcelid', 'fips', 'propertycountylandusecode',
                      'propertylandusedesc','rawcensustractandblock', 'roomcnt','yearbuilt', 
                      'censustractandblock', 'logerror', 'transactiondate']
-    # get data from wrangle part 1
-    df = wrangle_zillow()
-
-    # drop unneeded cols
-    df = df.drop(columns = unneeded_cols)
-    
-    # split data
-    train, validate, test = banana_split(df)
     
     # define variables for target, continous variables and categorical variables
     target = 'abs_logerror'
@@ -603,16 +2191,186 @@ def wrangle_pt2():
     # make list for columsn to use in the cluster
     cols_for_cluster = ['latitude', 'longitude', 'ppsqft']
     
-    #scale the columns 
-    train, validate, test, scaler = my_scaler2(train, validate, test, cont_vars, MinMaxScaler())
+    return [('drop_pt2_cols', drop_unneeded_cols, {'unneeded_cols': unneeded_cols}),
+            ('banana_split', split_stage, {}),
+            #scale the columns 
+            ('my_scaler2', scale_stage, {'col_names': cont_vars, 'scaler': MinMaxScaler()}),
+            #use the columns above to creat the location price cluster
+            ('make_this_cluster', cluster_stage, {'col_list': cols_for_cluster, 'k': k, 
+                                                  'col_name': ['clusters_locationprice']}),
+            # use function to get dummies added to dataframes
+            ('get_zillow_dummies', dummies_stage, {'cat_vars': cat_vars})]
+
+#########################
+
+def wrangle_pt2(k = 8, checkpoint_dir = None, compact = True, fused = False, assigner_path = None, artifact_path = None):
+    '''
+    Second part of the wrangle function. takes in Zillow dataframe, 
+    outputs train validate and test, ready to be split into X_ and y_ dataframes
+    Does the train validate test split, makes the cluster_locationprice
+    drops uneeded columns. and creates dummy column for cat variables
+    k = number of clusters for clusters_locationprice (default 8)
+    checkpoint_dir = optional folder for on disk checkpoints of every stage (wrangle_zillow's too), see run_stages.
+    i.e. wrangle_pt2(k = 6, checkpoint_dir = 'zillow_checkpoints') after a k = 8 run only redoes the clustering and dummies
+    compact, fused = passed on to wrangle_zillow's stages
+    assigner_path = optional .npz file to save a cluster.ClusterAssigner to, so new parcels can be put
+    in a clusters_locationprice cluster later without running all this again
+    artifact_path = optional .npz file to save a ZillowArtifact to (scaler, centroids, dummy columns and 
+    final column order), its transform turns raw rows into rows like these without refitting anything
+    returns train validate and test and a scaler
+    '''
+    # get data, then wrangle part 1 and part 2 as one list of stages
+    df = get_zillow_data()
+    
+    stages = zillow_stages(compact, fused) + pt2_stages(k)
+    
+    train, validate, test, scaler, kmeans, encoder = run_stages(df, stages, checkpoint_dir)
     
-    #use the columns above to creat the location price cluster, k = 8
-    train, validate, test, kmeans = make_this_cluster(train, validate, test, cols_for_cluster, 8, 
-                                                      col_name = ['clusters_locationprice'])
+    # pull the column lists back out of the stages so they can't drift apart
+    params = {name: params for name, func, params in stages}
     
-    # use function to get dummies added to dataframes
-    train, validate, test = get_zillow_dummies(train, validate, test)
+    if assigner_path is not None:
+        cluster.ClusterAssigner.from_fitted(scaler, kmeans, params['make_this_cluster']['col_list'], 
+                                            params['my_scaler2']['col_names']).save(assigner_path)
+        print(f'Saved cluster assigner to {assigner_path}')
+    
+    if artifact_path is not None:
+        ZillowArtifact.from_pt2(params, train, scaler, kmeans, encoder).save(artifact_path)
+        print(f'Saved preprocessing artifact to {artifact_path}')
     
     return train, validate, test, scaler
 
-#########################
\ No newline at end of file
+#########################
+
+class ZillowArtifact:
+    '''
+    Everything wrangle_pt2 learned from train, in one small file: the yearbuilt bin edges, the MinMax parameters,
+    the cluster centroids, the fitted DummyEncoder and the final column order.
+    transform(raw_df) turns rows straight from get_zillow_data into rows laid out like wrangle_pt2's train, 
+    nothing gets refit. Rows are not filtered (single homes, nulls, outliers), that is up to whoever calls it.
+    Make one with wrangle_pt2(artifact_path = ...) or ZillowArtifact.from_pt2, get it back with ZillowArtifact.load(path).
+    Loading is one np.load, no pickles and no sklearn objects.
+    '''
+    def __init__(self, year_bins, scale_cols, scale, offset, assigner, cluster_col, encoder, columns, 
+                 dtypes = None, categories = None):
+        self.year_bins = [float(edge) for edge in year_bins]
+        self.scale_cols = list(scale_cols)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.assigner = assigner
+        self.cluster_col = cluster_col
+        self.encoder = encoder
+        self.columns = list(columns)
+        # train's dtypes after compact_dtypes, {column: dtype name}, and the categories of its categorical columns
+        self.dtypes = dict(dtypes or {})
+        self.categories = dict(categories or {})
+    
+    @classmethod
+    def from_pt2(cls, params, train, scaler, kmeans, encoder):
+        '''
+        params = {stage name: params} from wrangle_pt2's stages
+        train = wrangle_pt2's final train, scaler / kmeans / encoder = what its stages fit
+        '''
+        scale_cols = params['my_scaler2']['col_names']
+        col_list = params['make_this_cluster']['col_list']
+        cluster_col = params['make_this_cluster']['col_name']
+        cluster_col = cluster_col[0] if isinstance(cluster_col, list) else cluster_col
+        
+        # yearbuilt edges come back out of the bins train was cut with
+        year_bins = encoder.categories['yearbuilt_bins']
+        year_bins = [year_bins[0].left] + [interval.right for interval in year_bins]
+        
+        # saved encoders match on strings, do the same here so a fresh artifact and a loaded one behave the same
+        encoder = DummyEncoder.from_state(encoder.get_state())
+        
+        # train's dtypes, so transform gives back the same compacted dtypes (category, int32...)
+        dtypes = {col: str(dtype) for col, dtype in train.dtypes.items()}
+        categories = {col: [str(value) for value in train[col].cat.categories] 
+                      for col in train.columns if isinstance(train[col].dtype, pd.CategoricalDtype)}
+        
+        return cls(year_bins, scale_cols, scaler.scale_, scaler.min_, 
+                   cluster.ClusterAssigner.from_fitted(scaler, kmeans, col_list, scale_cols), 
+                   cluster_col, encoder, train.columns, dtypes, categories)
+    
+    def save(self, path):
+        '''
+        Saves to one .npz file, arrays as arrays and everything else as a json string
+        (.npz gets added to path if it isn't there)
+        '''
+        meta = {'year_bins': self.year_bins, 'scale_cols': self.scale_cols, 'cluster_col': self.cluster_col,
+                'cluster_cols': self.assigner.col_list, 'encoder': self.encoder.get_state(), 'columns': self.columns,
+                'dtypes': self.dtypes, 'categories': self.categories}
+        
+        np.savez(cluster.npz_path(path), meta=np.array(json.dumps(meta)), scale=self.scale, offset=self.offset,
+                 cluster_scale=self.assigner.scale, cluster_offset=self.assigner.offset, 
+                 centroids=self.assigner.centroids)
+    
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a ZillowArtifact saved with save, path with or without the .npz
+        '''
+        with np.load(cluster.npz_path(path)) as saved:
+            meta = json.loads(str(saved['meta']))
+            assigner = cluster.ClusterAssigner(meta['cluster_cols'], saved['cluster_scale'], 
+                                               saved['cluster_offset'], saved['centroids'])
+            
+            return cls(meta['year_bins'], meta['scale_cols'], saved['scale'], saved['offset'], 
+                       assigner, meta['cluster_col'], DummyEncoder.from_state(meta['encoder']), meta['columns'],
+                       meta.get('dtypes'), meta.get('categories'))
+    
+    def transform(self, raw_df):
+        '''
+        Takes in raw zillow rows (like get_zillow_data returns) and returns a dataframe with the same columns, 
+        in the same order, as wrangle_pt2's train. abs_logerror is left out if there is no logerror.
+        '''
+        df = raw_df.copy()
+        
+        # same features wrangle_zillow makes, with train's bin edges
+        df = get_house_age(df)
+        df = yearbuilt_bins(df, self.year_bins)
+        df = get_tax_rate(df)
+        df = ppsqft(df)
+        df = cali_counties(df)
+        if 'logerror' in df.columns:
+            df = absolute_logerror(df)
+        
+        # clusters come from the raw values, then everything gets scaled in one go
+        df[self.cluster_col] = self.assigner.assign_frame(df)
+        df[self.scale_cols] = df[self.scale_cols].to_numpy(dtype=np.float64) * self.scale + self.offset
+        
+        # dummies with the columns train got
+        df = self.encoder.transform(df)
+        
+        df = df[[col for col in self.columns if col in df.columns]]
+        
+        return self.match_dtypes(df)
+    
+    def match_dtypes(self, df):
+        '''
+        Gives df's columns train's dtypes (the ones compact_dtypes picked), without changing any values.
+        Categoricals get train's categories, with any values train never saw added on the end.
+        Integer columns only go to train's int type if every value is a whole number that fits, 
+        otherwise they are left as they are.
+        '''
+        matched = {}
+        
+        for col in df.columns:
+            
+            dtype = self.dtypes.get(col)
+            s = df[col]
+            
+            if dtype is None or str(s.dtype) == dtype:
+                continue
+            
+            if col in self.categories:
+                categories = pd.Index(self.categories[col])
+                unseen = pd.Index(s.dropna().astype(str).unique()).difference(categories)
+                matched[col] = s.astype(pd.CategoricalDtype(categories.append(unseen)))
+            
+            elif np.dtype(dtype).kind in 'iu':
+                limits = np.iinfo(dtype)
+                if s.notna().all() and (s % 1 == 0).all() and s.between(limits.min, limits.max).all():
+                    matched[col] = s.astype(dtype)
+        
+        return df.assign(**matched)